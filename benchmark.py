@@ -0,0 +1,336 @@
+"""Generation throughput benchmark against a running WebUI API.
+
+Run against the port forwarded by WebUI.forward_port (i.e. while main.py is
+in the running state):
+
+    python benchmark.py
+
+Or against a stub server that returns canned outputs, to exercise the
+harness itself without a GPU:
+
+    python benchmark.py --stub
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import base64
+import json
+import math
+import os
+import threading
+import time
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataclasses_json import DataClassJsonMixin
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+DEFAULT_WEBUI_URL = "http://localhost:7860"
+DEFAULT_RESULTS_FILENAME = "benchmarks.jsonl"
+
+TXT2IMG_PATH = "/sdapi/v1/txt2img"
+TEXT2VIDEO_PATH = "/t2v/run"
+OPTIONS_PATH = "/sdapi/v1/options"
+
+KIND_TXT2IMG = "txt2img"
+KIND_TEXT2VIDEO = "text2video"
+
+BENCHMARK_PROMPT = "a photograph of an astronaut riding a horse"
+TEXT2VIDEO_FRAMES = 24
+# text2video runs on ModelScope, not the loaded SD checkpoint.
+TEXT2VIDEO_MODEL = "modelscope"
+
+
+@dataclass
+class Workload(DataClassJsonMixin):
+    kind: str
+    batch_size: int
+    concurrency: int
+    requests: int
+
+    @property
+    def path(self) -> str:
+        return TXT2IMG_PATH if self.kind == KIND_TXT2IMG else TEXT2VIDEO_PATH
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        if self.kind == KIND_TXT2IMG:
+            return {
+                "prompt": BENCHMARK_PROMPT,
+                "seed": 1,
+                "steps": 20,
+                "width": 512,
+                "height": 512,
+                "batch_size": self.batch_size,
+            }
+        return {
+            "prompt": BENCHMARK_PROMPT,
+            "seed": 1,
+            "steps": 30,
+            "frames": TEXT2VIDEO_FRAMES,
+            "width": 256,
+            "height": 256,
+            "batch_count": self.batch_size,
+        }
+
+    @property
+    def request_kwargs(self) -> Dict[str, Any]:
+        """Arguments for requests.post, text2video takes query parameters rather than JSON."""
+        if self.kind == KIND_TXT2IMG:
+            return {"json": self.payload}
+        return {"params": self.payload}
+
+    @property
+    def outputs_per_request(self) -> int:
+        """Images, or video frames, produced by a single request."""
+        if self.kind == KIND_TXT2IMG:
+            return self.batch_size
+        return self.batch_size * TEXT2VIDEO_FRAMES
+
+
+# Fixed matrix so results are comparable across instance types and over time.
+WORKLOADS: List[Workload] = [
+    Workload(kind=KIND_TXT2IMG, batch_size=batch_size, concurrency=concurrency, requests=8)
+    for batch_size in (1, 4, 8)
+    for concurrency in (1, 2, 4)
+] + [
+    Workload(kind=KIND_TEXT2VIDEO, batch_size=batch_size, concurrency=concurrency, requests=2)
+    for batch_size in (1, 2)
+    for concurrency in (1, 2)
+]
+
+
+@dataclass
+class BenchmarkResult(DataClassJsonMixin):
+    timestamp: float
+    instance_type: Optional[str]
+    launch_profile: Optional[str]
+    model: Optional[str]
+    workload: Workload
+    errors: int
+    wall_seconds: float
+    latency_mean_seconds: float
+    latency_p50_seconds: float
+    latency_p90_seconds: float
+    latency_p99_seconds: float
+    outputs_per_second: float
+
+    @property
+    def failed(self) -> bool:
+        """True if no request succeeded, so the timings mean nothing."""
+        return self.errors >= self.workload.requests
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile, returns 0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Benchmark:
+    """Runs workloads against a WebUI API and records the results."""
+
+    def __init__(
+        self,
+        url: str = DEFAULT_WEBUI_URL,
+        instance_type: Optional[str] = None,
+        launch_profile: Optional[str] = None,
+        timeout_seconds: float = 600,
+    ):
+        self.url = url.rstrip("/")
+        self.instance_type = instance_type
+        self.launch_profile = launch_profile
+        self.timeout_seconds = timeout_seconds
+
+    def get_model(self) -> Optional[str]:
+        """Returns the checkpoint the WebUI currently has loaded."""
+        try:
+            response = requests.get(self.url + OPTIONS_PATH, timeout=self.timeout_seconds)
+            response.raise_for_status()
+            return response.json().get("sd_model_checkpoint")
+        except requests.RequestException:
+            return None
+
+    def _timed_request(self, workload: Workload) -> Optional[float]:
+        start = time.monotonic()
+        try:
+            response = requests.post(
+                self.url + workload.path,
+                timeout=self.timeout_seconds,
+                **workload.request_kwargs,
+            )
+            response.raise_for_status()
+        except requests.RequestException:
+            return None
+        return time.monotonic() - start
+
+    def run_workload(self, workload: Workload, model: Optional[str]) -> BenchmarkResult:
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workload.concurrency) as executor:
+            timings = list(
+                executor.map(
+                    lambda _: self._timed_request(workload), range(workload.requests)
+                )
+            )
+        wall_seconds = time.monotonic() - start
+
+        latencies = [timing for timing in timings if timing is not None]
+        outputs = len(latencies) * workload.outputs_per_request
+        return BenchmarkResult(
+            timestamp=time.time(),
+            instance_type=self.instance_type,
+            launch_profile=self.launch_profile,
+            model=model,
+            workload=workload,
+            errors=len(timings) - len(latencies),
+            wall_seconds=wall_seconds,
+            latency_mean_seconds=sum(latencies) / len(latencies) if latencies else 0.0,
+            latency_p50_seconds=percentile(latencies, 50),
+            latency_p90_seconds=percentile(latencies, 90),
+            latency_p99_seconds=percentile(latencies, 99),
+            outputs_per_second=outputs / wall_seconds if wall_seconds else 0.0,
+        )
+
+    def run(self, workloads: List[Workload] = WORKLOADS) -> List[BenchmarkResult]:
+        sd_model = self.get_model()
+        results = []
+        for workload in workloads:
+            model = sd_model if workload.kind == KIND_TXT2IMG else TEXT2VIDEO_MODEL
+            result = self.run_workload(workload, model)
+            print(format_result(result))
+            results.append(result)
+        return results
+
+
+def format_result(result: BenchmarkResult) -> str:
+    workload = result.workload
+    unit = "images" if workload.kind == KIND_TXT2IMG else "frames"
+    return (
+        f"{workload.kind:<10} batch={workload.batch_size:<2} concurrency={workload.concurrency:<2} "
+        f"p50={result.latency_p50_seconds:.2f}s p90={result.latency_p90_seconds:.2f}s "
+        f"p99={result.latency_p99_seconds:.2f}s {result.outputs_per_second:.2f} {unit}/s "
+        f"errors={result.errors}"
+        + (" FAILED" if result.failed else "")
+    )
+
+
+def save_results(
+    results: List[BenchmarkResult], filename: str = DEFAULT_RESULTS_FILENAME
+) -> None:
+    """Appends results to a JSON lines file so runs can be compared over time.
+
+    Workloads where every request failed are skipped, since their zero
+    timings would skew comparisons.
+    """
+    with open(filename, "a") as f:
+        for result in results:
+            if not result.failed:
+                f.write(result.to_json() + "\n")
+
+
+def load_results(filename: str = DEFAULT_RESULTS_FILENAME) -> List[BenchmarkResult]:
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "r") as f:
+        return [BenchmarkResult.from_json(line) for line in f if line.strip()]
+
+
+# A 1x1 transparent PNG.
+STUB_IMAGE = base64.b64encode(
+    bytes.fromhex(
+        "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4"
+        "890000000d49444154789c6360000002000100e527de5c0000000049454e44ae426082"
+    )
+).decode()
+STUB_MODEL = "stub.safetensors [00000000]"
+
+
+class StubWebUIHandler(BaseHTTPRequestHandler):
+    """Answers the WebUI API endpoints used by the benchmark with canned outputs."""
+
+    # Seconds to sleep per output, to mimic generation time.
+    delay_seconds: float = 0.0
+
+    def do_GET(self):
+        if self.path == OPTIONS_PATH:
+            self._send_json({"sd_model_checkpoint": STUB_MODEL})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        path, _, query = self.path.partition("?")
+        if path == TXT2IMG_PATH:
+            payload = json.loads(body or b"{}")
+            count = int(payload.get("batch_size", 1))
+            time.sleep(self.delay_seconds * count)
+            self._send_json({"images": [STUB_IMAGE] * count})
+        elif path == TEXT2VIDEO_PATH:
+            # Like the text2video extension, only accept query parameters.
+            params = dict(urllib.parse.parse_qsl(query))
+            if "prompt" not in params:
+                self.send_error(422, "prompt is a required query parameter")
+                return
+            count = int(params.get("batch_count", 1))
+            time.sleep(self.delay_seconds * count)
+            self._send_json({"mp4s": [STUB_IMAGE] * count})
+        else:
+            self.send_error(404)
+
+    def _send_json(self, body: Any):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port: int = 0, delay_seconds: float = 0.0) -> ThreadingHTTPServer:
+    """Starts a stub WebUI on a background thread, port 0 picks a free port."""
+    handler = type("Handler", (StubWebUIHandler,), {"delay_seconds": delay_seconds})
+    server = ThreadingHTTPServer(("localhost", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", default=DEFAULT_WEBUI_URL)
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILENAME)
+    parser.add_argument("--stub", action="store_true", help="Benchmark a local stub server.")
+    parser.add_argument("--stub-delay", type=float, default=0.01)
+    args = parser.parse_args()
+
+    url = args.url
+    instance_type = launch_profile = None
+    if args.stub:
+        server = start_stub_server(delay_seconds=args.stub_delay)
+        url = f"http://localhost:{server.server_address[1]}"
+        instance_type = launch_profile = "stub"
+    else:
+        from webui import load_state
+
+        state = load_state()
+        instance_type = state.instance_type
+        launch_profile = state.launch_profile
+
+    benchmark = Benchmark(url, instance_type=instance_type, launch_profile=launch_profile)
+    results = benchmark.run()
+    save_results(results, args.results)
+    failed = sum(result.failed for result in results)
+    print(f"Saved {len(results) - failed} results to {args.results}, skipped {failed} that failed outright")
+
+
+if __name__ == "__main__":
+    main()
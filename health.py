@@ -0,0 +1,180 @@
+from typing import Callable, List, Optional
+import os
+import time
+
+from dataclasses import dataclass
+from dataclasses_json import DataClassJsonMixin
+
+from lambda_labs import (
+    InstanceDetails,
+    InstanceID,
+    LambdaAPI,
+    LambdaAPIError,
+    STATUS_ACTIVE,
+    STATUS_UNHEALTHY,
+)
+from remote import is_tcp_port_open
+
+
+# Failure kinds, in increasing order of severity.
+WEBUI_DOWN = "webui_down"
+INSTANCE_DOWN = "instance_down"
+
+RECOVERY_KIND_RESTART = "restart"
+RECOVERY_KIND_REPLACE = "replace"
+
+
+@dataclass
+class HealthCheck:
+    # None if the LambdaLabs API couldn't be reached.
+    instance_status: Optional[str]
+    ssh_reachable: bool
+    http_ready: bool
+
+    @property
+    def is_unknown(self) -> bool:
+        """True if nothing conclusive was learnt, e.g. because our own network is down.
+
+        That's only the case when the LambdaLabs API couldn't be reached and
+        SSH is unreachable too. An active instance whose SSH keeps failing
+        counts as down.
+        """
+        return self.instance_status is None and not self.ssh_reachable
+
+    @property
+    def failure(self) -> Optional[str]:
+        """Returns the kind of failure this check shows, or None if healthy or unknown."""
+        if self.instance_status is not None and self.instance_status != STATUS_ACTIVE:
+            return INSTANCE_DOWN
+        if self.is_unknown:
+            return None
+        if not self.ssh_reachable:
+            return INSTANCE_DOWN
+        if not self.http_ready:
+            return WEBUI_DOWN
+        return None
+
+
+class HealthSupervisor:
+    """Periodically checks the instance, SSH and the WebUI.
+
+    A failure is only reported after failure_threshold consecutive failed
+    checks, so one slow probe doesn't trigger a restart. Unknown checks
+    neither count towards nor reset the failures.
+    """
+
+    def __init__(
+        self,
+        lapi: LambdaAPI,
+        instance_id: InstanceID,
+        webui,
+        check_interval_seconds: float = 15,
+        failure_threshold: int = 3,
+        info: Callable[[str], None] = print,
+    ):
+        self.lapi = lapi
+        self.instance_id = instance_id
+        self.webui = webui
+        self.check_interval_seconds = check_interval_seconds
+        self.failure_threshold = failure_threshold
+        self.info = info
+        self.last_check: Optional[HealthCheck] = None
+        # Latest details from LambdaLabs, used when replacing the instance.
+        self.last_details: Optional[InstanceDetails] = None
+        self.consecutive_failures = 0
+        self.consecutive_unknown = 0
+        self._next_check = time.monotonic() + check_interval_seconds
+
+    def check(self) -> HealthCheck:
+        try:
+            details = self.lapi.get_instance_details(self.instance_id)
+        except (LambdaAPIError, OSError, ValueError):
+            # The API being unreachable says nothing about the instance.
+            ssh_reachable = self._is_ssh_reachable(self.webui.conn.host)
+            return HealthCheck(
+                instance_status=None,
+                ssh_reachable=ssh_reachable,
+                http_ready=ssh_reachable and self._is_http_ready(),
+            )
+        self.last_details = details
+        if not details.is_active or details.ip is None:
+            return HealthCheck(details.status, ssh_reachable=False, http_ready=False)
+        ssh_reachable = self._is_ssh_reachable(details.ip)
+        return HealthCheck(
+            details.status,
+            ssh_reachable=ssh_reachable,
+            http_ready=ssh_reachable and self._is_http_ready(),
+        )
+
+    def poll(self) -> Optional[str]:
+        """Checks health if a check is due, returning a failure kind once confirmed."""
+        if time.monotonic() < self._next_check:
+            return None
+        self._next_check = time.monotonic() + self.check_interval_seconds
+
+        self.last_check = self.check()
+        if self.last_check.is_unknown:
+            self.consecutive_unknown += 1
+            if self.consecutive_unknown == self.failure_threshold:
+                self.info(
+                    "Can't reach LambdaLabs or the instance over SSH, waiting until "
+                    "either answers."
+                )
+            return None
+        self.consecutive_unknown = 0
+        failure = self.last_check.failure
+        if failure is None:
+            self.consecutive_failures = 0
+            return None
+        self.consecutive_failures += 1
+        # LambdaLabs flagging the instance unhealthy is conclusive on its own.
+        if (
+            self.consecutive_failures >= self.failure_threshold
+            or self.last_check.instance_status == STATUS_UNHEALTHY
+        ):
+            return failure
+        return None
+
+    def _is_ssh_reachable(self, host: str) -> bool:
+        if not is_tcp_port_open(host, 22):
+            return False
+        try:
+            return self.webui.conn.run("true", hide=True, warn=True, timeout=10).exited == 0
+        except Exception:
+            return False
+
+    def _is_http_ready(self) -> bool:
+        try:
+            return self.webui.is_webui_accessible()
+        except Exception:
+            return False
+
+
+@dataclass
+class Recovery(DataClassJsonMixin):
+    timestamp: float
+    kind: str
+    failure: str
+    instance_type: Optional[str]
+    failed_instance: Optional[InstanceID]
+    recovered_instance: Optional[InstanceID]
+    # Seconds from the failure being detected to the WebUI running again.
+    seconds: float
+
+
+def save_recovery(recovery: Recovery, filename: str = "recoveries.jsonl") -> None:
+    with open(filename, "a") as f:
+        f.write(recovery.to_json() + "\n")
+
+
+def load_recoveries(filename: str = "recoveries.jsonl") -> List[Recovery]:
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "r") as f:
+        return [Recovery.from_json(line) for line in f if line.strip()]
+
+
+def mean_time_to_recovery(recoveries: List[Recovery]) -> Optional[float]:
+    if not recoveries:
+        return None
+    return sum(recovery.seconds for recovery in recoveries) / len(recoveries)
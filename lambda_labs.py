@@ -71,6 +71,10 @@ class InstanceDetails(DataClassJsonMixin):
     def is_terminated(self) -> bool:
         return self.status == STATUS_TERMINATED
 
+    @property
+    def is_unhealthy(self) -> bool:
+        return self.status == STATUS_UNHEALTHY
+
 @dataclass
 class SSHKey(DataClassJsonMixin):
     id: str
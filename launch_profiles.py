@@ -0,0 +1,89 @@
+from typing import Dict, List, Optional
+from dataclasses import dataclass, field
+from dataclasses_json import DataClassJsonMixin
+
+from lambda_labs import InstanceType
+
+
+class LaunchProfileError(Exception):
+    pass
+
+
+@dataclass
+class LaunchProfile(DataClassJsonMixin):
+    """A named set of WebUI COMMANDLINE_ARGS tuned for a class of hardware."""
+
+    name: str
+    commandline_args: List[str] = field(default_factory=list)
+
+    @property
+    def commandline(self) -> str:
+        return " ".join(self.commandline_args)
+
+    def webui_user_script(self) -> str:
+        """Returns the contents of webui-user.sh for this profile."""
+        return (
+            "#!/bin/bash\n"
+            f"# Generated by lambda-sd-webui, launch profile: {self.name}\n"
+            f'export COMMANDLINE_ARGS="{self.commandline}"\n'
+        )
+
+
+DEFAULT_PROFILE = LaunchProfile(
+    name="default",
+    commandline_args=["--api", "--xformers"],
+)
+
+LAUNCH_PROFILES: Dict[str, LaunchProfile] = {
+    profile.name: profile
+    for profile in [
+        DEFAULT_PROFILE,
+        # 40GB cards use memory efficient SDP attention to leave headroom
+        # for large batches and text2video.
+        LaunchProfile(
+            name="a100-40gb",
+            commandline_args=["--api", "--opt-sdp-attention", "--no-half-vae"],
+        ),
+        # 80GB cards trade VRAM for speed with the non memory efficient
+        # SDP kernels.
+        LaunchProfile(
+            name="a100-80gb",
+            commandline_args=["--api", "--opt-sdp-no-mem-attention", "--no-half-vae"],
+        ),
+        # xformers wheels lag behind Hopper support, so stick to torch SDP.
+        LaunchProfile(
+            name="h100",
+            commandline_args=["--api", "--opt-sdp-no-mem-attention", "--no-half-vae"],
+        ),
+    ]
+}
+
+
+def get_launch_profile(name: str) -> LaunchProfile:
+    """Returns the launch profile with the given name."""
+    if name not in LAUNCH_PROFILES:
+        raise LaunchProfileError(
+            f"Unknown launch profile {name}, expected one of {', '.join(LAUNCH_PROFILES)}"
+        )
+    return LAUNCH_PROFILES[name]
+
+
+def select_launch_profile(
+    instance_type: InstanceType, override: Optional[str] = None
+) -> LaunchProfile:
+    """Picks the fastest known launch profile for an instance type.
+
+    If override is given, that profile is used regardless of hardware.
+    """
+    if override:
+        return get_launch_profile(override)
+
+    name = instance_type.name.lower()
+    description = instance_type.description.lower()
+    if "h100" in name:
+        return get_launch_profile("h100")
+    if "a100" in name:
+        if "80gb" in name or "80 gb" in description:
+            return get_launch_profile("a100-80gb")
+        return get_launch_profile("a100-40gb")
+    return DEFAULT_PROFILE
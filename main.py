@@ -46,9 +46,14 @@ import subprocess
 
 
 def main():
-    from webui import StateMachine
-    state_machine = StateMachine()
-    state_machine.run()
+    # The dashboard needs an interactive terminal, WEBUI_DASHBOARD=0 prints plain logs instead.
+    if os.environ.get("WEBUI_DASHBOARD", "1") == "0":
+        from webui import StateMachine
+        state_machine = StateMachine()
+        state_machine.run()
+        return
+    import ui
+    ui.main()
     return
 #    api = LambdaAPI()
 #    from instances import prompt_user_for_instance_type
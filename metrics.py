@@ -0,0 +1,341 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import argparse
+import array
+import math
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+import fabric
+
+
+FIELDS = [
+    "gpu_utilization_percent",
+    "gpu_memory_used_mib",
+    "gpu_memory_total_mib",
+    "gpu_power_watts",
+    "cpu_utilization_percent",
+    "memory_used_mib",
+    "memory_total_mib",
+    "disk_used_gib",
+    "disk_read_bytes_per_second",
+    "disk_write_bytes_per_second",
+    "network_rx_bytes_per_second",
+    "network_tx_bytes_per_second",
+]
+
+# Emits one block of tagged lines per sample, terminated by "E", so a single
+# long-lived channel streams every sample rather than one SSH exec per
+# figure. The nvidia-smi command is substituted so tests can use a fake.
+SAMPLER_SCRIPT = """
+while true; do
+  echo "T $(date +%s.%N)"
+  {nvidia_smi} --query-gpu=utilization.gpu,memory.used,memory.total,power.draw --format=csv,noheader,nounits | sed 's/^/G /'
+  head -1 /proc/stat
+  awk '/^MemTotal:/ {{t=$2}} /^MemAvailable:/ {{a=$2}} END {{print "M", t, a}}' /proc/meminfo
+  df -B1 --output=used / | tail -1 | sed 's/^/D /'
+  awk '$3 ~ /^(nvme[0-9]+n[0-9]+|sd[a-z]+|vd[a-z]+)$/ {{r+=$6; w+=$10}} END {{print "I", r*512, w*512}}' /proc/diskstats
+  awk 'NR>2 && $1 != "lo:" {{rx+=$2; tx+=$10}} END {{print "N", rx, tx}}' /proc/net/dev
+  echo E
+  sleep {interval}
+done
+"""
+
+
+def _parse_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        # nvidia-smi reports unsupported figures as [N/A].
+        return math.nan
+
+
+class RingBuffer:
+    """Fixed-size buffer of timestamped samples backed by one array per field."""
+
+    def __init__(self, capacity: int, fields: List[str] = FIELDS):
+        self.capacity = capacity
+        self.fields = fields
+        self.timestamps = array.array("d", [0.0] * capacity)
+        self.values = {name: array.array("d", [0.0] * capacity) for name in fields}
+        self.count = 0
+        self._next = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, timestamp: float, sample: Dict[str, float]):
+        self.timestamps[self._next] = timestamp
+        for name in self.fields:
+            self.values[name][self._next] = sample.get(name, math.nan)
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _indices(self, last_n: Optional[int] = None) -> List[int]:
+        n = self.count if last_n is None else min(last_n, self.count)
+        start = (self._next - n) % self.capacity
+        return [(start + i) % self.capacity for i in range(n)]
+
+    def series(self, name: str, last_n: Optional[int] = None) -> List[Tuple[float, float]]:
+        """Returns (timestamp, value) pairs for a field, oldest first."""
+        values = self.values[name]
+        return [(self.timestamps[i], values[i]) for i in self._indices(last_n)]
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        if not self.count:
+            return None
+        index = (self._next - 1) % self.capacity
+        return {name: self.values[name][index] for name in self.fields}
+
+    def mean(self, name: str, last_n: Optional[int] = None) -> float:
+        values = [
+            self.values[name][i]
+            for i in self._indices(last_n)
+            if not math.isnan(self.values[name][i])
+        ]
+        return sum(values) / len(values) if values else math.nan
+
+
+class MetricsBuffer:
+    """Keeps recent samples at full rate and older ones averaged down.
+
+    Every downsample_factor raw samples are averaged into one retained
+    sample, so with the defaults and a 1 second interval there are 10
+    minutes of raw samples and 24 hours of one minute averages.
+    """
+
+    def __init__(
+        self,
+        raw_capacity: int = 600,
+        downsampled_capacity: int = 1440,
+        downsample_factor: int = 60,
+    ):
+        self.raw = RingBuffer(raw_capacity)
+        self.downsampled = RingBuffer(downsampled_capacity)
+        self.downsample_factor = downsample_factor
+        self._pending: List[Tuple[float, Dict[str, float]]] = []
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: float, sample: Dict[str, float]):
+        with self._lock:
+            self.raw.append(timestamp, sample)
+            self._pending.append((timestamp, sample))
+            if len(self._pending) >= self.downsample_factor:
+                self.downsampled.append(
+                    self._pending[-1][0],
+                    {
+                        name: _nanmean([pending.get(name, math.nan) for _, pending in self._pending])
+                        for name in FIELDS
+                    },
+                )
+                self._pending = []
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        with self._lock:
+            return self.raw.latest()
+
+    def bottleneck(self, last_n: int = 30) -> str:
+        """Rough guess at what's limiting the instance over the last samples."""
+        with self._lock:
+            gpu = self.raw.mean("gpu_utilization_percent", last_n)
+            rx = self.raw.mean("network_rx_bytes_per_second", last_n)
+            disk = self.raw.mean("disk_write_bytes_per_second", last_n)
+        if not self.raw.count:
+            return "unknown"
+        if gpu >= 80:
+            return "gpu-bound"
+        if rx >= 10 * 2**20 or disk >= 50 * 2**20:
+            return "download-bound"
+        if gpu < 5:
+            return "idle"
+        return "underutilized"
+
+
+def _nanmean(values: List[float]) -> float:
+    values = [value for value in values if not math.isnan(value)]
+    return sum(values) / len(values) if values else math.nan
+
+
+def _nansum(values: List[float]) -> float:
+    values = [value for value in values if not math.isnan(value)]
+    return sum(values) if values else math.nan
+
+
+class MetricsSampler:
+    """Streams GPU and host metrics from the instance into a MetricsBuffer."""
+
+    def __init__(
+        self,
+        conn: fabric.Connection,
+        interval_seconds: float = 1.0,
+        buffer: Optional[MetricsBuffer] = None,
+        nvidia_smi_command: str = "nvidia-smi",
+        info: Callable[[str], None] = print,
+    ):
+        self.conn = conn
+        self.interval_seconds = interval_seconds
+        self.buffer = buffer or MetricsBuffer()
+        self.nvidia_smi_command = nvidia_smi_command
+        self.info = info
+        self._channel = None
+        self._thread: Optional[threading.Thread] = None
+        # Previous cumulative counters, used to turn totals into rates.
+        self._previous: Optional[Dict[str, float]] = None
+        self.malformed_samples = 0
+
+    @property
+    def script(self) -> str:
+        return SAMPLER_SCRIPT.format(
+            nvidia_smi=self.nvidia_smi_command, interval=self.interval_seconds
+        )
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.conn.open()
+        self._channel = self.conn.client.get_transport().open_session()
+        self._channel.exec_command(f"bash -c {shlex.quote(self.script)}")
+        self._thread = threading.Thread(
+            target=self._run, args=(self._channel,), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, channel):
+        try:
+            self.consume(channel.makefile("r"))
+        except (OSError, EOFError) as e:
+            # Channel closed by stop() or the instance went away.
+            self.info(f"Metrics sampler stopped: {e}")
+
+    def consume(self, lines: Iterable[str]):
+        """Parses sampler script output into the buffer until it ends."""
+        block: List[str] = []
+        for line in lines:
+            line = line.strip()
+            if line == "E":
+                try:
+                    self.parse_block(block)
+                except (IndexError, ValueError) as e:
+                    # e.g. an nvidia-smi layout we don't understand, skip the sample.
+                    self.malformed_samples += 1
+                    if self.malformed_samples == 1:
+                        self.info(f"Skipping malformed metrics samples: {e}")
+                block = []
+            elif line:
+                block.append(line)
+
+    def parse_block(self, lines: List[str]):
+        """Parses one sample block and appends it to the buffer."""
+        timestamp = 0.0
+        gpus: List[List[float]] = []
+        counters: Dict[str, float] = {}
+        sample: Dict[str, float] = {}
+        for line in lines:
+            tag, _, rest = line.partition(" ")
+            fields = rest.replace(",", " ").split()
+            if tag == "T":
+                timestamp = float(fields[0])
+            elif tag == "G":
+                gpus.append([_parse_float(field) for field in fields])
+            elif tag == "cpu":
+                values = [float(field) for field in fields]
+                # idle + iowait
+                counters["cpu_idle"] = values[3] + values[4]
+                counters["cpu_total"] = sum(values)
+            elif tag == "M":
+                total_kib, available_kib = float(fields[0]), float(fields[1])
+                sample["memory_total_mib"] = total_kib / 1024
+                sample["memory_used_mib"] = (total_kib - available_kib) / 1024
+            elif tag == "D":
+                sample["disk_used_gib"] = float(fields[0]) / 2**30
+            elif tag == "I":
+                counters["disk_read"], counters["disk_write"] = map(float, fields)
+            elif tag == "N":
+                counters["network_rx"], counters["network_tx"] = map(float, fields)
+
+        if gpus:
+            sample["gpu_utilization_percent"] = _nanmean([gpu[0] for gpu in gpus])
+            sample["gpu_memory_used_mib"] = sum(gpu[1] for gpu in gpus)
+            sample["gpu_memory_total_mib"] = sum(gpu[2] for gpu in gpus)
+            sample["gpu_power_watts"] = _nansum([gpu[3] for gpu in gpus])
+
+        counters["timestamp"] = timestamp
+        previous, self._previous = self._previous, counters
+        if previous is not None:
+            elapsed = timestamp - previous["timestamp"]
+            cpu_total = counters.get("cpu_total", 0) - previous.get("cpu_total", 0)
+            if cpu_total > 0:
+                cpu_idle = counters["cpu_idle"] - previous["cpu_idle"]
+                sample["cpu_utilization_percent"] = 100 * (1 - cpu_idle / cpu_total)
+            if elapsed > 0:
+                for counter, field in [
+                    ("disk_read", "disk_read_bytes_per_second"),
+                    ("disk_write", "disk_write_bytes_per_second"),
+                    ("network_rx", "network_rx_bytes_per_second"),
+                    ("network_tx", "network_tx_bytes_per_second"),
+                ]:
+                    if counter in counters and counter in previous:
+                        sample[field] = (counters[counter] - previous[counter]) / elapsed
+
+        self.buffer.append(timestamp, sample)
+
+
+
+# Stand-in for nvidia-smi, printing the CSV the sampler queries for with
+# random utilization. With malformed set, every other call prints a line
+# with too few fields, like some MIG layouts.
+FAKE_NVIDIA_SMI = """#!/bin/bash
+for i in $(seq {gpus}); do
+  echo "$((RANDOM % 101)), $((RANDOM % 40960)), 40960, [N/A]"
+done
+if [ -n "{malformed}" ] && [ $((RANDOM % 2)) -eq 0 ]; then
+  echo "MIG 1g.5gb"
+fi
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the metrics sampler locally against a fake nvidia-smi."
+    )
+    parser.add_argument("--gpus", type=int, default=2)
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--malformed", action="store_true", help="Emit malformed GPU lines too.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fake_nvidia_smi = os.path.join(directory, "nvidia-smi")
+        with open(fake_nvidia_smi, "w") as f:
+            f.write(FAKE_NVIDIA_SMI.format(gpus=args.gpus, malformed="1" if args.malformed else ""))
+        os.chmod(fake_nvidia_smi, 0o755)
+
+        buffer = MetricsBuffer()
+        sampler = MetricsSampler(None, args.interval, buffer, nvidia_smi_command=fake_nvidia_smi)
+        process = subprocess.Popen(["bash", "-c", sampler.script], stdout=subprocess.PIPE, text=True)
+        threading.Thread(target=sampler.consume, args=(process.stdout,), daemon=True).start()
+        try:
+            printed = 0
+            while printed < args.samples:
+                time.sleep(args.interval)
+                if len(buffer.raw) > printed:
+                    printed = len(buffer.raw)
+                    print(buffer.latest())
+        finally:
+            process.kill()
+        print(f"{len(buffer.raw)} samples, {sampler.malformed_samples} malformed, {buffer.bottleneck()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+import os
+import shlex
+
+from dataclasses import dataclass, field
+from dataclasses_json import DataClassJsonMixin
+
+import fabric
+
+from remote import RemoteHost
+
+
+WEBUI_MODELS_DIRECTORY = "/home/ubuntu/stable-diffusion-webui/models"
+MODELSCOPE_MODEL_PATH = os.path.join(WEBUI_MODELS_DIRECTORY, "text2video/modelscope")
+# Older releases of the text2video extension look for ModelScope here instead.
+MODELSCOPE_LEGACY_MODEL_PATH = os.path.join(WEBUI_MODELS_DIRECTORY, "ModelScope/t2v")
+
+# Cache of verified hashes on the instance, keyed by inode, so multi-GB
+# files (and their hardlinks) are only hashed once rather than on every start.
+MODEL_HASHES_FILE = os.path.join(WEBUI_MODELS_DIRECTORY, ".model-hashes.json")
+
+KIND_CHECKPOINT = "checkpoint"
+KIND_LORA = "lora"
+KIND_TEXT2VIDEO = "text2video"
+
+MODEL_SCOPE_BASE_URL = (
+    "https://huggingface.co/damo-vilab/modelscope-damo-text-to-video-synthesis/resolve/main"
+)
+MODEL_SCOPE_FILES = [
+    "VQGAN_autoencoder.pth",
+    "configuration.json",
+    "open_clip_pytorch_model.bin",
+    "text2video_pytorch_model.pth",
+]
+
+
+class ModelError(Exception):
+    pass
+
+
+@dataclass
+class ModelFile(DataClassJsonMixin):
+    """A file that should be present on the instance.
+
+    The file is downloaded to the first of paths, every other path is a
+    hardlink to it. If size or sha256 are given, they're checked before the
+    file is treated as installed. Without a size, the Content-Length the
+    server reports for url is checked instead, so a truncated file is never
+    mistaken for a complete one.
+    """
+
+    name: str
+    kind: str
+    url: str
+    paths: List[str]
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+
+
+@dataclass
+class ModelManifest(DataClassJsonMixin):
+    files: List[ModelFile] = field(default_factory=list)
+
+    def of_kind(self, kind: str) -> List[ModelFile]:
+        return [model for model in self.files if model.kind == kind]
+
+
+DEFAULT_MANIFEST = ModelManifest(
+    files=[
+        ModelFile(
+            name=f"modelscope/{filename}",
+            kind=KIND_TEXT2VIDEO,
+            url=f"{MODEL_SCOPE_BASE_URL}/{filename}",
+            paths=[
+                os.path.join(MODELSCOPE_MODEL_PATH, filename),
+                os.path.join(MODELSCOPE_LEGACY_MODEL_PATH, filename),
+            ],
+        )
+        for filename in MODEL_SCOPE_FILES
+    ]
+)
+
+
+def load_manifest(filename: str = "models.json") -> ModelManifest:
+    """Loads the model manifest, falling back to the default if there's no file."""
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            return ModelManifest.from_json(f.read())
+    else:
+        return DEFAULT_MANIFEST
+
+
+class ModelManager:
+    """Makes the models on an instance match a manifest."""
+
+    def __init__(
+        self,
+        conn: fabric.Connection,
+        manifest: ModelManifest = DEFAULT_MANIFEST,
+        info: Callable[[str], None] = print,
+    ):
+        self.conn = conn
+        self.host = RemoteHost(conn)
+        self.manifest = manifest
+        self.info = info
+        self._hashes: Optional[Dict[str, Tuple[str, int, int]]] = None
+        self._remote_sizes: Dict[str, Optional[int]] = {}
+
+    def stat(self, path: str) -> Optional[Tuple[int, int, int]]:
+        """Returns (size, mtime, inode) of a remote file, or None if it doesn't exist."""
+        result = self.conn.run(
+            f"stat -c '%s %Y %i' {shlex.quote(path)}", warn=True, hide=True
+        )
+        if result.exited != 0:
+            return None
+        size, mtime, inode = result.stdout.split()
+        return int(size), int(mtime), int(inode)
+
+    def file_hash(self, path: str) -> Optional[str]:
+        """Returns the sha256 of a remote file, hashing it only if it changed since last time."""
+        stat = self.stat(path)
+        if stat is None:
+            return None
+        size, mtime, inode = stat
+
+        hashes = self._load_hashes()
+        cached = hashes.get(str(inode))
+        if cached is not None and cached[1] == size and cached[2] == mtime:
+            return cached[0]
+
+        self.info(f"Hashing {path}...")
+        result = self.conn.run(f"sha256sum {shlex.quote(path)}", hide=True)
+        sha256 = result.stdout.split()[0]
+        hashes[str(inode)] = (sha256, size, mtime)
+        self._save_hashes()
+        return sha256
+
+    def expected_size(self, model: ModelFile) -> Optional[int]:
+        """Returns the size of model from the manifest, or the server's Content-Length."""
+        if model.size is not None:
+            return model.size
+        if model.url not in self._remote_sizes:
+            result = self.conn.run(
+                f"curl -sfIL --max-time 30 {shlex.quote(model.url)}", warn=True, hide=True
+            )
+            size = None
+            if result.exited == 0:
+                # With -L every redirect's headers are printed, the last response is the file.
+                for line in result.stdout.splitlines():
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length" and value.strip().isdigit():
+                        size = int(value.strip())
+            if size is None:
+                self.info(f"Couldn't get the size of {model.name}, it won't be verified.")
+            self._remote_sizes[model.url] = size
+        return self._remote_sizes[model.url]
+
+    def is_installed_at(self, model: ModelFile, path: str) -> bool:
+        """Returns True if path holds a complete, verified copy of model."""
+        stat = self.stat(path)
+        if stat is None:
+            return False
+        expected_size = self.expected_size(model)
+        if expected_size is not None and stat[0] != expected_size:
+            return False
+        if model.sha256 is not None and self.file_hash(path) != model.sha256:
+            return False
+        return True
+
+    def installed_path(self, model: ModelFile) -> Optional[str]:
+        for path in model.paths:
+            if self.is_installed_at(model, path):
+                return path
+        return None
+
+    def missing(self, kind: Optional[str] = None) -> List[ModelFile]:
+        """Returns manifest entries that have no verified copy on the instance."""
+        return [
+            model
+            for model in self.manifest.files
+            if (kind is None or model.kind == kind) and self.installed_path(model) is None
+        ]
+
+    def is_complete(self, kind: Optional[str] = None) -> bool:
+        """Returns True if every model, and all its hardlinks, are installed."""
+        for model in self.manifest.files:
+            if kind is not None and model.kind != kind:
+                continue
+            if not all(self.is_installed_at(model, path) for path in model.paths):
+                return False
+        return True
+
+    def sync(self, kind: Optional[str] = None):
+        """Fetches missing models and hardlinks every model into all its paths."""
+        for model in self.manifest.files:
+            if kind is not None and model.kind != kind:
+                continue
+            source = self.installed_path(model) or self._find_duplicate(model)
+            if source is None:
+                source = self.download(model)
+            for path in model.paths:
+                self._link(source, path)
+
+    def download(self, model: ModelFile) -> str:
+        """Downloads a model to its first path, returning that path.
+
+        The download goes to a .part file that's resumed on retry and only
+        renamed into place once complete and verified.
+        """
+        path = model.paths[0]
+        partial_path = path + ".part"
+        self.info(f"Downloading {model.name} from {model.url}")
+        self.conn.run(f"mkdir -p {shlex.quote(os.path.dirname(path))}", hide=True)
+        self.conn.run(
+            f"wget -c --progress=dot:giga -O {shlex.quote(partial_path)} {shlex.quote(model.url)}"
+        )
+        if not self.is_installed_at(model, partial_path):
+            self.conn.run(f"rm -f {shlex.quote(partial_path)}", hide=True)
+            raise ModelError(f"Downloaded {model.name} failed verification")
+        self.conn.run(f"mv {shlex.quote(partial_path)} {shlex.quote(path)}", hide=True)
+        return path
+
+    def _find_duplicate(self, model: ModelFile) -> Optional[str]:
+        """Returns the path of an installed manifest file with the same content."""
+        if model.sha256 is None:
+            return None
+        for other in self.manifest.files:
+            if other is model or other.sha256 != model.sha256:
+                continue
+            path = self.installed_path(other)
+            if path is not None:
+                self.info(f"{model.name} has the same content as {other.name}, linking.")
+                return path
+        return None
+
+    def _link(self, source: str, path: str):
+        if source == path:
+            return
+        source_stat = self.stat(source)
+        path_stat = self.stat(path)
+        if source_stat and path_stat and source_stat[2] == path_stat[2]:
+            return
+        self.conn.run(
+            f"mkdir -p {shlex.quote(os.path.dirname(path))} && ln -f {shlex.quote(source)} {shlex.quote(path)}",
+            hide=True,
+        )
+
+    def _load_hashes(self) -> Dict[str, Tuple[str, int, int]]:
+        if self._hashes is None:
+            contents = self.host.read_file(MODEL_HASHES_FILE)
+            self._hashes = {
+                inode: tuple(entry) for inode, entry in json.loads(contents or "{}").items()
+            }
+        return self._hashes
+
+    def _save_hashes(self):
+        self.host.write_file(MODEL_HASHES_FILE, json.dumps(self._load_hashes()))
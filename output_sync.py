@@ -0,0 +1,211 @@
+from typing import Callable, List, Optional
+import gzip
+import os
+import queue
+import shlex
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import fabric
+import paramiko
+
+
+# Outputs that are already compressed aren't worth gzipping in transit.
+ALREADY_COMPRESSED_EXTENSIONS = {
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".webp",
+    ".gif",
+    ".mp4",
+    ".webm",
+    ".zip",
+    ".gz",
+}
+
+
+@dataclass
+class RemoteFile:
+    # Path relative to the remote outputs directory.
+    path: str
+    size: int
+    mtime: float
+
+    @property
+    def is_compressible(self) -> bool:
+        return os.path.splitext(self.path)[1].lower() not in ALREADY_COMPRESSED_EXTENSIONS
+
+
+class OutputSync:
+    """Incrementally copies a remote outputs directory to local storage.
+
+    Files are compared by size and modification time, so only new or
+    changed files are transferred. Transfers run in parallel over several
+    SFTP channels multiplexed on the connection's existing SSH transport.
+    """
+
+    def __init__(
+        self,
+        conn: fabric.Connection,
+        remote_directory: str,
+        local_directory: str,
+        channels: int = 4,
+        poll_interval_seconds: float = 10,
+        settle_seconds: float = 5,
+        info: Callable[[str], None] = print,
+        on_transferred: Optional[Callable[[str], None]] = None,
+    ):
+        self.conn = conn
+        self.remote_directory = remote_directory
+        self.local_directory = local_directory
+        self.channels = channels
+        self.poll_interval_seconds = poll_interval_seconds
+        # Files modified more recently than this may still be being written.
+        self.settle_seconds = settle_seconds
+        self.info = info
+        # Called with the local path of each file once it's fully copied.
+        self.on_transferred = on_transferred
+
+        self.files_transferred = 0
+        self.bytes_transferred = 0
+
+        self._sftp_clients: queue.Queue = queue.Queue()
+        self._sftp_client_count = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def transport(self) -> paramiko.Transport:
+        self.conn.open()
+        return self.conn.client.get_transport()
+
+    def list_remote_files(self) -> List[RemoteFile]:
+        """Returns all files under the remote directory, empty if it doesn't exist."""
+        result = self.conn.run(
+            f"find {self.remote_directory} -type f -printf '%P\\t%s\\t%T@\\n'",
+            warn=True,
+            hide=True,
+        )
+        if result.exited != 0:
+            return []
+        files = []
+        for line in result.stdout.splitlines():
+            path, size, mtime = line.rsplit("\t", 2)
+            files.append(RemoteFile(path=path, size=int(size), mtime=float(mtime)))
+        return files
+
+    def remote_time(self) -> float:
+        return float(self.conn.run("date +%s", hide=True).stdout.strip())
+
+    def needs_sync(self, remote_file: RemoteFile) -> bool:
+        local_path = os.path.join(self.local_directory, remote_file.path)
+        if not os.path.exists(local_path):
+            return True
+        stat = os.stat(local_path)
+        return stat.st_size != remote_file.size or int(stat.st_mtime) != int(
+            remote_file.mtime
+        )
+
+    def sync_once(self, include_unsettled: bool = False) -> int:
+        """Transfers new or changed files, returns the number transferred.
+
+        Unless include_unsettled is True, files modified within the last
+        settle_seconds are left for the next pass.
+        """
+        with self._sync_lock:
+            now = self.remote_time()
+            pending = [
+                remote_file
+                for remote_file in self.list_remote_files()
+                if self.needs_sync(remote_file)
+                and (include_unsettled or now - remote_file.mtime >= self.settle_seconds)
+            ]
+            if not pending:
+                return 0
+            with ThreadPoolExecutor(max_workers=self.channels) as executor:
+                list(executor.map(self._transfer, pending))
+            return len(pending)
+
+    def flush(self) -> int:
+        """Blocks until every remote file, including unsettled ones, is copied locally."""
+        count = self.sync_once(include_unsettled=True)
+        self.info(
+            f"Synced {self.files_transferred} files ({self.bytes_transferred / 2**20:.1f} MiB) to {self.local_directory}"
+        )
+        return count
+
+    def start(self):
+        """Starts syncing in the background every poll_interval_seconds."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops background syncing, waiting for any in-progress pass to finish."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        while not self._sftp_clients.empty():
+            self._sftp_clients.get().close()
+        self._sftp_client_count = 0
+
+    def _run(self):
+        while not self._stopped.wait(self.poll_interval_seconds):
+            try:
+                self.sync_once()
+            except Exception as e:
+                self.info(f"Output sync failed, retrying: {e}")
+
+    def _acquire_sftp(self) -> paramiko.SFTPClient:
+        with self._lock:
+            if self._sftp_clients.empty() and self._sftp_client_count < self.channels:
+                self._sftp_client_count += 1
+                return paramiko.SFTPClient.from_transport(self.transport)
+        return self._sftp_clients.get()
+
+    def _transfer(self, remote_file: RemoteFile):
+        remote_path = os.path.join(self.remote_directory, remote_file.path)
+        local_path = os.path.join(self.local_directory, remote_file.path)
+        partial_path = local_path + ".part"
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        if remote_file.is_compressible:
+            self._transfer_compressed(remote_path, partial_path)
+        else:
+            sftp = self._acquire_sftp()
+            try:
+                sftp.get(remote_path, partial_path)
+            finally:
+                self._sftp_clients.put(sftp)
+
+        os.utime(partial_path, (remote_file.mtime, remote_file.mtime))
+        os.replace(partial_path, local_path)
+        with self._lock:
+            self.files_transferred += 1
+            self.bytes_transferred += remote_file.size
+        if self.on_transferred is not None:
+            self.on_transferred(local_path)
+
+    def _transfer_compressed(self, remote_path: str, local_path: str):
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command(f"gzip -c {shlex.quote(remote_path)}")
+            with gzip.GzipFile(fileobj=channel.makefile("rb")) as source, open(
+                local_path, "wb"
+            ) as destination:
+                shutil.copyfileobj(source, destination)
+            if channel.recv_exit_status() != 0:
+                raise IOError(f"Failed to read {remote_path}")
+        finally:
+            channel.close()
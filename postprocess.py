@@ -0,0 +1,292 @@
+"""Local post-processing of text2video clips as they arrive from the instance.
+
+Clips are handed to a process pool as soon as OutputSync copies them, and
+run through a configurable list of ffmpeg steps. At most max_pending clips
+are queued or in flight; submitting more blocks the caller, so a slow
+encoder applies backpressure to the sync rather than buffering without
+bound. Per-step timings show whether encoding keeps up with the GPU.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from dataclasses_json import DataClassJsonMixin
+
+
+CLIP_EXTENSIONS = {".mp4", ".webm", ".gif"}
+
+
+class PostProcessError(Exception):
+    pass
+
+
+def get_ffmpeg() -> str:
+    """Returns the ffmpeg binary, preferring the one bundled with imageio-ffmpeg."""
+    try:
+        import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise PostProcessError("ffmpeg not found, install it or imageio-ffmpeg")
+        return ffmpeg
+
+
+def _run_ffmpeg(args: List[str]):
+    result = subprocess.run(
+        [get_ffmpeg(), "-y", "-loglevel", "error"] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise PostProcessError(result.stderr.decode().strip())
+
+
+def _output_path(input_path: str, output_directory: str, suffix: str) -> str:
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_directory, stem + suffix)
+
+
+def transcode(
+    input_path: str,
+    output_directory: str,
+    codec: str = "libx264",
+    crf: int = 20,
+    preset: str = "veryfast",
+) -> str:
+    output_path = _output_path(input_path, output_directory, ".transcoded.mp4")
+    _run_ffmpeg(
+        [
+            "-i", input_path,
+            "-c:v", codec,
+            "-crf", str(crf),
+            "-preset", preset,
+            "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart",
+            output_path,
+        ]
+    )
+    return output_path
+
+
+def upscale(input_path: str, output_directory: str, scale: int = 2) -> str:
+    output_path = _output_path(input_path, output_directory, ".upscaled.mp4")
+    _run_ffmpeg(
+        [
+            "-i", input_path,
+            "-vf", f"scale=iw*{scale}:ih*{scale}:flags=lanczos",
+            "-pix_fmt", "yuv420p",
+            output_path,
+        ]
+    )
+    return output_path
+
+
+def thumbnail(input_path: str, output_directory: str) -> str:
+    output_path = _output_path(input_path, output_directory, ".jpg")
+    _run_ffmpeg(["-i", input_path, "-frames:v", "1", output_path])
+    return output_path
+
+
+def concatenate(input_paths: List[str], output_path: str):
+    """Joins clips end to end without re-encoding."""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        for path in input_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+        list_path = f.name
+    try:
+        _run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path])
+    finally:
+        os.remove(list_path)
+
+
+# Steps that produce the next version of the clip.
+TRANSFORMS: Dict[str, Callable[..., str]] = {
+    "transcode": transcode,
+    "upscale": upscale,
+}
+# Steps that produce a side output and leave the clip unchanged.
+SIDE_OUTPUTS: Dict[str, Callable[..., str]] = {
+    "thumbnail": thumbnail,
+}
+
+
+@dataclass
+class Step(DataClassJsonMixin):
+    name: str
+    options: Dict[str, Any] = field(default_factory=dict)
+
+
+DEFAULT_STEPS = [Step("transcode"), Step("thumbnail")]
+
+
+def process_clip(input_path: str, output_directory: str, steps: List[Step]) -> Dict[str, Any]:
+    """Runs steps over one clip in a worker process.
+
+    Returns the final clip path and the seconds spent in each step.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    timings: Dict[str, float] = {}
+    current = input_path
+    for step in steps:
+        start = time.monotonic()
+        if step.name in TRANSFORMS:
+            current = TRANSFORMS[step.name](current, output_directory, **step.options)
+        elif step.name in SIDE_OUTPUTS:
+            SIDE_OUTPUTS[step.name](current, output_directory, **step.options)
+        else:
+            raise PostProcessError(f"Unknown post-processing step {step.name}")
+        timings[step.name] = time.monotonic() - start
+    return {"output_path": current, "timings": timings}
+
+
+@dataclass
+class StageTiming:
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class PostProcessor:
+    """Feeds clips through a process pool with bounded concurrency and memory."""
+
+    def __init__(
+        self,
+        output_directory: str,
+        steps: Optional[List[Step]] = None,
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        concatenate_output: Optional[str] = None,
+        input_directory: Optional[str] = None,
+        info: Callable[[str], None] = print,
+    ):
+        self.output_directory = output_directory
+        # Clips under input_directory keep their relative directory in
+        # output_directory, so same-named clips don't overwrite each other.
+        self.input_directory = input_directory
+        self.steps = DEFAULT_STEPS if steps is None else steps
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) // 2)
+        self.max_pending = max_pending or self.max_workers * 2
+        # If set, every processed clip is joined into this file on close().
+        self.concatenate_output = concatenate_output
+        self.info = info
+
+        # Time spent waiting for a free slot, queued and in each step.
+        self.timings: Dict[str, StageTiming] = {}
+        self.failures = 0
+        # (arrival index, final clip path) of each processed clip.
+        self._outputs: List[Tuple[int, str]] = []
+        self._submitted = 0
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._futures: List[Future] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_clip(path: str) -> bool:
+        return os.path.splitext(path)[1].lower() in CLIP_EXTENSIONS
+
+    @property
+    def outputs(self) -> List[str]:
+        """Final clip paths in the order the clips arrived."""
+        with self._lock:
+            return [path for _, path in sorted(self._outputs)]
+
+    def clip_output_directory(self, path: str) -> str:
+        """Returns where a clip's outputs go, mirroring its place under input_directory."""
+        if self.input_directory is None:
+            return self.output_directory
+        relative = os.path.relpath(
+            os.path.dirname(os.path.abspath(path)), os.path.abspath(self.input_directory)
+        )
+        if relative == os.curdir or relative.startswith(os.pardir):
+            return self.output_directory
+        return os.path.join(self.output_directory, relative)
+
+    @property
+    def pending(self) -> int:
+        return sum(not future.done() for future in self._futures)
+
+    def submit(self, path: str):
+        """Queues a clip, blocking while max_pending clips are already queued."""
+        if not self.is_clip(path):
+            return
+        with self._lock:
+            if self._executor is None:
+                # Forking from a process running sync, health and tunnel
+                # threads can copy a held lock into the child and hang it.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+        start = time.monotonic()
+        self._slots.acquire()
+        self._record("backpressure", time.monotonic() - start)
+
+        submitted = time.monotonic()
+        future = self._executor.submit(process_clip, path, self.clip_output_directory(path), self.steps)
+        with self._lock:
+            index = self._submitted
+            self._submitted += 1
+        future.add_done_callback(lambda future: self._done(path, index, submitted, future))
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()] + [future]
+
+    def close(self):
+        """Waits for every queued clip, then concatenates if configured."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        outputs = self.outputs
+        if self.concatenate_output and outputs:
+            start = time.monotonic()
+            concatenate(outputs, self.concatenate_output)
+            self._record("concatenate", time.monotonic() - start)
+        self.info(self.summary())
+
+    def summary(self) -> str:
+        with self._lock:
+            stages = ", ".join(
+                f"{name} {timing.mean_seconds:.2f}s avg / {timing.max_seconds:.2f}s max"
+                for name, timing in self.timings.items()
+            )
+            processed = len(self._outputs)
+        return f"Post-processed {processed} clips ({self.failures} failed): {stages}"
+
+    def _done(self, path: str, index: int, submitted: float, future: Future):
+        self._slots.release()
+        self._record("total", time.monotonic() - submitted)
+        try:
+            result = future.result()
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            self.info(f"Post-processing {path} failed: {e}")
+            return
+        with self._lock:
+            self._outputs.append((index, result["output_path"]))
+        for name, seconds in result["timings"].items():
+            self._record(name, seconds)
+
+    def _record(self, name: str, seconds: float):
+        with self._lock:
+            self.timings.setdefault(name, StageTiming()).add(seconds)
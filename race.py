@@ -0,0 +1,153 @@
+from typing import Callable, Dict, List, Optional
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from dataclasses_json import DataClassJsonMixin
+
+from lambda_labs import (
+    InstanceDetails,
+    InstanceID,
+    InstanceTypeName,
+    LambdaAPI,
+    LambdaAPIError,
+    RegionName,
+)
+from remote import is_tcp_port_open
+
+
+@dataclass
+class RaceResult(DataClassJsonMixin):
+    """Outcome of a launch race, used to judge whether racing pays for itself."""
+
+    timestamp: float
+    instance_type: Optional[str]
+    winner: InstanceID
+    winner_region: RegionName
+    # Seconds from launch until the winner was active and SSH reachable.
+    seconds_to_ready: float
+    losers: List[InstanceID] = field(default_factory=list)
+    # Billed time and cost of the terminated losers.
+    loser_instance_seconds: float = 0.0
+    loser_cost_cents: float = 0.0
+
+
+def get_race_regions(
+    api: LambdaAPI, instance_type_name: InstanceTypeName, count: Optional[int] = None
+) -> List[RegionName]:
+    """Returns up to count regions with capacity for an instance type, US regions first."""
+    for offer in api.get_offered_instance_types():
+        if offer.instance_type.name != instance_type_name:
+            continue
+        regions = [region.name for region in offer.regions_with_capacity_available]
+        regions.sort(key=lambda region: not region.startswith("us"))
+        return regions[:count]
+    return []
+
+
+def save_race_result(result: RaceResult, filename: str = "races.jsonl") -> None:
+    with open(filename, "a") as f:
+        f.write(result.to_json() + "\n")
+
+
+class InstanceRace:
+    """Watches several speculatively launched instances and keeps the first ready one."""
+
+    def __init__(
+        self,
+        lapi: LambdaAPI,
+        instance_ids: List[InstanceID],
+        launch_time: float,
+        price_cents_per_hour: Optional[int],
+        poll_interval_seconds: float = 2,
+        ssh_port: int = 22,
+        info: Callable[[str], None] = print,
+    ):
+        self.lapi = lapi
+        self.instance_ids = instance_ids
+        self.launch_time = launch_time
+        self.price_cents_per_hour = price_cents_per_hour
+        self.poll_interval_seconds = poll_interval_seconds
+        self.ssh_port = ssh_port
+        self.info = info
+        # When each instance was first seen terminated on its own.
+        self.terminated_at: Dict[InstanceID, float] = {}
+
+    def _get_details(self, instance_id: InstanceID) -> Optional[InstanceDetails]:
+        """Returns an instance's details, or None if the API call failed this poll."""
+        try:
+            return self.lapi.get_instance_details(instance_id)
+        except (LambdaAPIError, OSError, ValueError) as e:
+            self.info(f"Failed to get details of {instance_id}, retrying: {e}")
+            return None
+
+    def _is_ready(self, details: Optional[InstanceDetails]) -> bool:
+        return (
+            details is not None
+            and details.is_active
+            and details.ip is not None
+            and is_tcp_port_open(details.ip, self.ssh_port)
+        )
+
+    def wait_for_winner(self) -> Optional[InstanceDetails]:
+        """Blocks until one instance is active and SSH reachable.
+
+        Returns None if every instance terminated before becoming ready.
+        """
+        candidates = list(self.instance_ids)
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            while candidates:
+                details = list(executor.map(self._get_details, candidates))
+                ready = list(executor.map(self._is_ready, details))
+                for instance, is_ready in zip(details, ready):
+                    if is_ready:
+                        return instance
+
+                statuses: Dict[str, int] = {}
+                for instance in details:
+                    status = instance.status if instance is not None else "unknown"
+                    statuses[status] = statuses.get(status, 0) + 1
+                self.info(
+                    f"Racing {len(candidates)} instances ({', '.join(f'{count} {status}' for status, count in statuses.items())}), checking again in {self.poll_interval_seconds} seconds..."
+                )
+                now = time.time()
+                remaining = []
+                for instance_id, instance in zip(candidates, details):
+                    # Instances whose details couldn't be fetched are retried next poll.
+                    if instance is not None and instance.is_terminated:
+                        self.terminated_at.setdefault(instance_id, now)
+                    else:
+                        remaining.append(instance_id)
+                candidates = remaining
+                time.sleep(self.poll_interval_seconds)
+        return None
+
+    def finish(self, winner: InstanceDetails) -> RaceResult:
+        """Terminates every instance but the winner and records what the race cost."""
+        now = time.time()
+        losers = [instance_id for instance_id in self.instance_ids if instance_id != winner.id]
+        running_losers = [
+            instance_id for instance_id in losers if instance_id not in self.terminated_at
+        ]
+        if running_losers:
+            self.info(f"Terminating {len(running_losers)} instances that lost the race.")
+            self.lapi.terminate_instances(running_losers)
+
+        # Losers that terminated on their own stopped billing when they did.
+        loser_instance_seconds = sum(
+            self.terminated_at.get(instance_id, now) - self.launch_time for instance_id in losers
+        )
+        loser_cost_cents = 0.0
+        if self.price_cents_per_hour is not None:
+            loser_cost_cents = loser_instance_seconds / 3600 * self.price_cents_per_hour
+
+        return RaceResult(
+            timestamp=now,
+            instance_type=winner.instance_type.name,
+            winner=winner.id,
+            winner_region=winner.region.name,
+            seconds_to_ready=now - self.launch_time,
+            losers=losers,
+            loser_instance_seconds=loser_instance_seconds,
+            loser_cost_cents=loser_cost_cents,
+        )
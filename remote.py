@@ -1,4 +1,12 @@
+import os
+import random
+import shlex
+import socket
+import time
+from typing import Optional
+
 import fabric
+import paramiko
 
 
 class RemoteHost:
@@ -19,11 +27,28 @@ class RemoteHost:
         """Returns True if a file exists, False otherwise."""
         return self.conn.run(f"test -f {path}", warn=True, hide=True).exited == 0
 
-    def localhost_port_serving_http(self, port: int) -> bool:
-        """Returns True if localhost:port is responding to HTTP requests."""
+    def read_file(self, path: str) -> Optional[str]:
+        """Returns the contents of a file, or None if it can't be read."""
+        result = self.conn.run(f"cat {path}", warn=True, hide=True)
+        if result.exited != 0:
+            return None
+        return result.stdout
+
+    def write_file(self, path: str, contents: str):
+        """Replaces the contents of a file."""
+        self.conn.run(f"printf %s {shlex.quote(contents)} > {path}", hide=True)
+
+    def localhost_port_serving_http(self, port: int, timeout_seconds: int = 10) -> bool:
+        """Returns True if localhost:port is responding to HTTP requests.
+
+        A server that accepts connections but doesn't answer within
+        timeout_seconds counts as not responding.
+        """
         return (
             self.conn.run(
-                f"curl localhost:{port} > /dev/null", warn=True, hide=True
+                f"curl -s --max-time {timeout_seconds} localhost:{port} > /dev/null",
+                warn=True,
+                hide=True,
             ).exited
             == 0
         )
@@ -36,3 +61,148 @@ class RemoteHost:
             hide=True,
         )
         return result.exited == 0 and process_name in result.stdout
+
+    def localhost_http_post_json(
+        self, port: int, path: str, body: str, timeout_seconds: int = 300
+    ) -> bool:
+        """Returns True if a JSON POST to localhost:port/path succeeds within timeout_seconds."""
+        return (
+            self.conn.run(
+                f"curl -sf --max-time {timeout_seconds} -X POST -H 'Content-Type: application/json' "
+                f"-d {shlex.quote(body)} localhost:{port}{path} > /dev/null",
+                warn=True,
+                hide=True,
+            ).exited
+            == 0
+        )
+
+
+def is_tcp_port_open(host: str, port: int, timeout_seconds: float = 2.0) -> bool:
+    """Returns True if a TCP connection to host:port succeeds."""
+    try:
+        with socket.create_connection((host, port), timeout=timeout_seconds):
+            return True
+    except OSError:
+        return False
+
+
+def _jittered_delays(initial_delay_seconds: float, max_delay_seconds: float):
+    """Yields exponentially growing delays with full jitter."""
+    delay = initial_delay_seconds
+    while True:
+        yield random.uniform(0, delay)
+        delay = min(max_delay_seconds, delay * 2)
+
+
+def wait_for_tcp_port(
+    host: str,
+    port: int,
+    timeout_seconds: float,
+    initial_delay_seconds: float = 0.1,
+    max_delay_seconds: float = 0.5,
+) -> bool:
+    """Probes host:port with tight jittered retries until it accepts connections.
+
+    Returns False if it didn't within timeout_seconds.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    for delay in _jittered_delays(initial_delay_seconds, max_delay_seconds):
+        remaining = deadline - time.monotonic()
+        if is_tcp_port_open(host, port, max(0.1, min(2.0, remaining))):
+            return True
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, max(0.0, remaining)))
+    return False
+
+
+def fetch_host_key(host: str, port: int = 22, timeout_seconds: float = 10) -> paramiko.PKey:
+    """Returns the SSH host key a server presents, without authenticating."""
+    with socket.create_connection((host, port), timeout=timeout_seconds) as sock:
+        transport = paramiko.Transport(sock)
+        try:
+            transport.start_client(timeout=timeout_seconds)
+            return transport.get_remote_server_key()
+        finally:
+            transport.close()
+
+
+def fetch_host_key_with_retries(
+    host: str,
+    timeout_seconds: float,
+    port: int = 22,
+    initial_delay_seconds: float = 0.2,
+    max_delay_seconds: float = 2.0,
+) -> paramiko.PKey:
+    """Fetches host's key, retrying while sshd accepts TCP but drops the handshake."""
+    deadline = time.monotonic() + timeout_seconds
+    for delay in _jittered_delays(initial_delay_seconds, max_delay_seconds):
+        try:
+            return fetch_host_key(host, port)
+        except (paramiko.SSHException, EOFError, OSError):
+            if time.monotonic() + delay >= deadline:
+                raise
+            time.sleep(delay)
+
+
+def _known_hosts_line_matches(hostname: str, host: str) -> bool:
+    if hostname.startswith("|1|"):
+        # Hashed entry, |1|salt|hash
+        salt = hostname.split("|")[2]
+        return paramiko.HostKeys.hash_host(host, salt) == hostname
+    return hostname == host
+
+
+def pin_host_key(host: str, key: paramiko.PKey, known_hosts_path: str):
+    """Records key as the only known host key for host.
+
+    LambdaLabs reuses IPs between instances, so every existing entry for the
+    host is dropped rather than left to fail host key checking. Lines that
+    also name other hosts keep their entry for those hosts, and comments and
+    unrelated lines are left untouched.
+    """
+    lines = []
+    if os.path.exists(known_hosts_path):
+        with open(known_hosts_path, "r") as f:
+            lines = f.read().splitlines()
+
+    kept = []
+    for line in lines:
+        fields = line.split()
+        # Comments and marker lines such as @cert-authority are left alone.
+        if not fields or fields[0].startswith(("#", "@")):
+            kept.append(line)
+            continue
+        hostnames = fields[0].split(",")
+        remaining = [
+            hostname for hostname in hostnames if not _known_hosts_line_matches(hostname, host)
+        ]
+        if len(remaining) == len(hostnames):
+            kept.append(line)
+        elif remaining:
+            kept.append(" ".join([",".join(remaining)] + fields[1:]))
+    kept.append(f"{host} {key.get_name()} {key.get_base64()}")
+
+    directory = os.path.dirname(os.path.abspath(known_hosts_path))
+    os.makedirs(directory, exist_ok=True)
+    with open(known_hosts_path + ".tmp", "w") as f:
+        f.write("\n".join(kept) + "\n")
+    os.replace(known_hosts_path + ".tmp", known_hosts_path)
+
+
+def open_with_retries(
+    conn: fabric.Connection,
+    timeout_seconds: float,
+    initial_delay_seconds: float = 0.2,
+    max_delay_seconds: float = 2.0,
+):
+    """Opens conn, retrying while sshd is up but not yet accepting our key."""
+    deadline = time.monotonic() + timeout_seconds
+    for delay in _jittered_delays(initial_delay_seconds, max_delay_seconds):
+        try:
+            conn.open()
+            return
+        except (paramiko.SSHException, OSError):
+            if time.monotonic() + delay >= deadline:
+                raise
+            time.sleep(delay)
@@ -0,0 +1,437 @@
+"""Content-addressed cache of WebUI generation results.
+
+Results are keyed by the API path, the full request parameters and the hash
+of the loaded model, so repeating a prompt/seed/sampler/model combination
+returns the stored response without touching the instance. Only requests
+with a fixed seed are cached, since a random seed never repeats.
+
+API clients get cache hits by talking to the CachingProxy port instead of
+the WebUI port directly. To estimate the GPU time a job file still needs:
+
+    python result_cache.py estimate jobs.jsonl
+"""
+from typing import Any, Dict, Optional, Tuple
+import argparse
+import collections
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import urllib.parse
+
+from dataclasses import dataclass
+from dataclasses_json import DataClassJsonMixin
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+CACHEABLE_PATHS = {
+    "/sdapi/v1/txt2img",
+    "/sdapi/v1/img2img",
+    "/t2v/run",
+}
+OPTIONS_PATH = "/sdapi/v1/options"
+# Upstream responses meaning the WebUI is down rather than the request being bad.
+RETRY_STATUS_CODES = {502, 503}
+DEFAULT_CACHE_DIRECTORY = "cache"
+INDEX_FILENAME = "index.json"
+
+
+def is_cacheable(path: str, payload: Dict[str, Any]) -> bool:
+    try:
+        # Query parameters, as text2video takes, arrive as strings.
+        seed = int(payload.get("seed", -1))
+    except (TypeError, ValueError):
+        return False
+    return path in CACHEABLE_PATHS and seed != -1
+
+
+def _normalize_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _normalize_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize_value(v) for v in value]
+    if isinstance(value, str):
+        for parse in (int, float):
+            try:
+                number = parse(value)
+            except ValueError:
+                continue
+            # Leaves prompts like "nan" or "inf" alone.
+            if math.isfinite(number):
+                value = number
+            break
+        else:
+            return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def normalize_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Coerces numeric strings and whole floats to numbers.
+
+    text2video takes its parameters in the query string, so the proxy sees
+    "seed": "1" where a job file has "seed": 1; both must hash the same.
+    """
+    return _normalize_value(payload)
+
+
+def cache_key(path: str, payload: Dict[str, Any], model_hash: str) -> str:
+    """Returns the content address of a generation request."""
+    canonical = json.dumps(
+        {"path": path, "payload": normalize_payload(payload), "model": model_hash},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of response bodies stored on disk.
+
+    Each response is a file named by its key. The index maps keys to
+    [path, size, seconds the generation took] in least to most recently
+    used order, and is rewritten atomically whenever entries are added or
+    evicted. Hits only reorder entries, so they're saved at most every
+    index_save_interval_seconds, and on close().
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIRECTORY,
+        max_bytes: int = 10 * 2**30,
+        index_save_interval_seconds: float = 30,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_save_interval_seconds = index_save_interval_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[str, Tuple[str, int, float]]" = (
+            collections.OrderedDict()
+        )
+        self._total_bytes = 0
+        self._index_dirty = False
+        self._index_saved = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._index_dirty = True
+            if time.monotonic() - self._index_saved >= self.index_save_interval_seconds:
+                self._save_index()
+        with open(self._blob_path(key), "rb") as f:
+            return f.read()
+
+    def put(self, key: str, path: str, body: bytes, seconds: float):
+        blob_path = self._blob_path(key)
+        with open(blob_path + ".tmp", "wb") as f:
+            f.write(body)
+        os.replace(blob_path + ".tmp", blob_path)
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._total_bytes -= previous[1]
+            self._entries[key] = (path, len(body), seconds)
+            self._entries.move_to_end(key)
+            self._total_bytes += len(body)
+            self._evict()
+            self._save_index()
+
+    def close(self):
+        """Saves any recency changes not yet written to the index."""
+        with self._lock:
+            if self._index_dirty:
+                self._save_index()
+
+    def mean_seconds(self, path: Optional[str] = None) -> Optional[float]:
+        """Average generation time of cached results, optionally for one API path."""
+        with self._lock:
+            seconds = [
+                entry_seconds
+                for entry_path, _, entry_seconds in self._entries.values()
+                if path is None or entry_path == path
+            ]
+        return sum(seconds) / len(seconds) if seconds else None
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, (_, size, _) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._blob_path(key))
+            except FileNotFoundError:
+                pass
+
+    def _blob_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path()):
+            return
+        with open(self._index_path(), "r") as f:
+            for key, (path, size, seconds) in json.load(f):
+                if os.path.exists(self._blob_path(key)):
+                    self._entries[key] = (path, size, seconds)
+                    self._total_bytes += size
+
+    def _save_index(self):
+        with open(self._index_path() + ".tmp", "w") as f:
+            json.dump(
+                [[key, list(entry)] for key, entry in self._entries.items()],
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(self._index_path() + ".tmp", self._index_path())
+        self._index_dirty = False
+        self._index_saved = time.monotonic()
+
+
+def get_model_hash(url: str) -> str:
+    """Returns the hash of the checkpoint the WebUI has loaded."""
+    response = requests.get(url + OPTIONS_PATH, timeout=30)
+    response.raise_for_status()
+    options = response.json()
+    return options.get("sd_checkpoint_hash") or options.get("sd_model_checkpoint") or ""
+
+
+class CachingProxy:
+    """HTTP proxy in front of the WebUI API that answers repeated generations from a ResultCache."""
+
+    def __init__(
+        self,
+        cache: ResultCache,
+        upstream_url: str,
+        port: int,
+        model_hash_ttl_seconds: float = 10,
+        retry_timeout_seconds: float = 0,
+        retry_interval_seconds: float = 5,
+    ):
+        self.cache = cache
+        self.upstream_url = upstream_url.rstrip("/")
+        self.port = port
+        self.model_hash_ttl_seconds = model_hash_ttl_seconds
+        # While the WebUI is being restarted or replaced, requests are held and
+        # retried for up to this long instead of failing.
+        self.retry_timeout_seconds = retry_timeout_seconds
+        self.retry_interval_seconds = retry_interval_seconds
+        # Requests that were retried at least once because the WebUI was down.
+        self.requeued = 0
+        self._model_hash: Optional[Tuple[float, str]] = None
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def model_hash(self) -> str:
+        now = time.monotonic()
+        if self._model_hash is None or now - self._model_hash[0] > self.model_hash_ttl_seconds:
+            try:
+                self._model_hash = (now, get_model_hash(self.upstream_url))
+            except requests.RequestException:
+                # Keep using the last known model while the WebUI is down.
+                if self._model_hash is None:
+                    raise
+        return self._model_hash[1]
+
+    def upstream_request(self, method: str, path: str, body: bytes, headers: Dict[str, str]):
+        """Sends a request to the WebUI, retrying while it's unreachable."""
+        deadline = time.monotonic() + self.retry_timeout_seconds
+        requeued = False
+        while True:
+            try:
+                response = requests.request(
+                    method, self.upstream_url + path, data=body, headers=headers
+                )
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+            except requests.ConnectionError:
+                if time.monotonic() >= deadline:
+                    raise
+                response = None
+            if time.monotonic() >= deadline:
+                return response
+            if not requeued:
+                requeued = True
+                self.requeued += 1
+            time.sleep(self.retry_interval_seconds)
+
+    def start(self):
+        proxy = self
+
+        class Handler(_ProxyHandler):
+            pass
+
+        Handler.proxy = proxy
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.cache.close()
+
+    def __enter__(self) -> "CachingProxy":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    proxy: CachingProxy
+
+    def do_GET(self):
+        self._forward()
+
+    def do_POST(self):
+        self._forward()
+
+    def _forward(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+
+        key = None
+        path, _, query = self.path.partition("?")
+        if self.command == "POST" and path in CACHEABLE_PATHS:
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                payload = {}
+            if not isinstance(payload, dict):
+                payload = {}
+            # text2video takes its arguments as query parameters.
+            payload.update(urllib.parse.parse_qsl(query))
+            if is_cacheable(path, payload):
+                try:
+                    key = cache_key(path, payload, self.proxy.model_hash())
+                except requests.RequestException:
+                    # The model isn't known until the WebUI is up, so don't cache.
+                    key = None
+            if key is not None:
+                cached = self.proxy.cache.get(key)
+                if cached is not None:
+                    self._respond(200, "application/json", cached, cache_status="HIT")
+                    return
+
+        start = time.monotonic()
+        headers = {
+            name: value
+            for name, value in self.headers.items()
+            if name.lower() not in ("host", "content-length", "connection")
+        }
+        try:
+            response = self.proxy.upstream_request(self.command, self.path, body, headers)
+        except requests.ConnectionError:
+            self._respond(502, "text/plain", b"WebUI unreachable", cache_status=None)
+            return
+        content_type = response.headers.get("Content-Type", "application/octet-stream")
+        if key is not None and response.status_code == 200:
+            self.proxy.cache.put(key, path, response.content, time.monotonic() - start)
+        self._respond(
+            response.status_code,
+            content_type,
+            response.content,
+            cache_status="MISS" if key is not None else None,
+        )
+
+    def _respond(self, status: int, content_type: str, body: bytes, cache_status: Optional[str]):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if cache_status is not None:
+            self.send_header("X-Cache", cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@dataclass
+class JobEstimate(DataClassJsonMixin):
+    jobs: int
+    cached: int
+    uncached: int
+    # None when there's no timing data to estimate from.
+    estimated_gpu_seconds: Optional[float]
+
+
+def estimate_job_file(cache: ResultCache, filename: str, model_hash: str) -> JobEstimate:
+    """Checks a job file against the cache and estimates the GPU time still needed.
+
+    Each line of the job file is either {"path": ..., "payload": {...}} or a
+    bare txt2img payload.
+    """
+    jobs = cached = 0
+    gpu_seconds: Optional[float] = 0.0
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            path = job.get("path", "/sdapi/v1/txt2img")
+            payload = job.get("payload", job)
+            jobs += 1
+            if is_cacheable(path, payload) and cache_key(path, payload, model_hash) in cache:
+                cached += 1
+                continue
+            seconds = cache.mean_seconds(path) or cache.mean_seconds()
+            gpu_seconds = None if seconds is None or gpu_seconds is None else gpu_seconds + seconds
+    return JobEstimate(
+        jobs=jobs,
+        cached=cached,
+        uncached=jobs - cached,
+        estimated_gpu_seconds=gpu_seconds,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generation result cache tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    estimate = subparsers.add_parser("estimate", help="Estimate GPU time left for a job file.")
+    estimate.add_argument("job_file")
+    estimate.add_argument("--url", default="http://localhost:7860")
+    estimate.add_argument("--model-hash", help="Use this model hash instead of asking the WebUI.")
+    estimate.add_argument("--cache-directory", default=DEFAULT_CACHE_DIRECTORY)
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache_directory)
+    model_hash = args.model_hash or get_model_hash(args.url)
+    result = estimate_job_file(cache, args.job_file, model_hash)
+    print(f"{result.cached} of {result.jobs} jobs are cached, {result.uncached} need the GPU.")
+    if result.estimated_gpu_seconds is None:
+        print("No timing data yet to estimate GPU time from.")
+    else:
+        print(f"Estimated GPU time left: {result.estimated_gpu_seconds / 60:.1f} minutes.")
+
+
+if __name__ == "__main__":
+    main()
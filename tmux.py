@@ -31,14 +31,14 @@ class TmuxSession:
             hide=True,
         )
 
-    def open_terminal(self, detatch_others=True, readonly=True):
+    def open_terminal(self, detatch_others=True, readonly=True, ssh_options: Optional[List[str]] = None):
         """Opens a terminal on the local host.
 
         This will SSH into the destination connection and attach to
         the existing tmux session.
 
         """
-        ssh_command = self._build_ssh_command(detatch_others, readonly)
+        ssh_command = self._build_ssh_command(detatch_others, readonly, ssh_options)
 
         if sys.platform == "linux":
             args = [
@@ -61,19 +61,16 @@ class TmuxSession:
 
         subprocess.run(args)
 
-    def _build_ssh_command(self, detatch_others=True, readonly=False):
+    def _build_ssh_command(self, detatch_others=True, readonly=False, ssh_options: Optional[List[str]] = None):
         destination = f"{self.conn.user}@{self.conn.host}"
         args = [
             "ssh",
             "-t",
             "-o",
             "'StrictHostKeyChecking accept-new'",
-            destination,
-            "tmux",
-            "attach",
-            "-t",
-            self.name,
         ]
+        args += ssh_options or []
+        args += [destination, "tmux", "attach", "-t", self.name]
         if readonly:
             args.append("-r")
         if detatch_others:
@@ -89,6 +86,17 @@ class TmuxSession:
         )
         return [window.split(":")[0] for window in window_list]
 
+    def capture_window(self, index: int, lines: int = 50) -> List[str]:
+        """Returns the last lines of output from a tmux window."""
+        result = self.conn.run(
+            f"tmux capture-pane -p -t {self.name}:{index} -S -{lines}",
+            hide=True,
+            warn=True,
+        )
+        if result.exited != 0:
+            return []
+        return result.stdout.rstrip("\n").split("\n")[-lines:]
+
     def select_window(self, index: int):
         self.conn.run(f"tmux select-window -t {self.name}:{index}")
 
@@ -0,0 +1,497 @@
+"""Port forwarding from the local machine to the instance.
+
+Two modes are supported:
+
+* native: an OpenSSH ``ssh -N -L`` subprocess does the forwarding, so
+  encryption runs in C rather than in paramiko. Several tunnels to the same
+  host share one SSH connection through a ControlMaster socket.
+* channel: direct-tcpip channels multiplexed on an existing paramiko
+  transport, with larger windows and packets than fabric's forward_local.
+
+Either way local connections pass through a small relay that counts bytes
+and connect latency per tunnel. The relay moves one bounded chunk at a time
+per direction and blocks on send, so a slow reader applies backpressure
+instead of data piling up in memory.
+
+Run ``python tunnel.py`` to benchmark bulk transfer through an in-process
+SSH server stand-in.
+"""
+from typing import Callable, Deque, Dict, List, Optional
+import abc
+import argparse
+import collections
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import paramiko
+
+
+MODE_NATIVE = "native"
+MODE_CHANNEL = "channel"
+
+# Bytes moved per read, and so the most a relay direction ever buffers.
+RELAY_CHUNK_SIZE = 256 * 1024
+CHANNEL_WINDOW_SIZE = 16 * 2**20
+CHANNEL_MAX_PACKET_SIZE = 2**17
+
+
+class TunnelError(Exception):
+    pass
+
+
+class TunnelStats:
+    """Throughput and latency counters for one tunnel."""
+
+    def __init__(self, latency_samples: int = 100):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connections = 0
+        self.active_connections = 0
+        # Seconds to open the upstream side of each recent connection.
+        self.connect_latencies: Deque[float] = collections.deque(maxlen=latency_samples)
+        self._lock = threading.Lock()
+
+    def add(self, sent: int = 0, received: int = 0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def connection_opened(self, latency_seconds: float):
+        with self._lock:
+            self.connections += 1
+            self.active_connections += 1
+            self.connect_latencies.append(latency_seconds)
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            latencies = sorted(self.connect_latencies)
+            return {
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "connections": self.connections,
+                "active_connections": self.active_connections,
+                "connect_latency_p50_seconds": latencies[len(latencies) // 2] if latencies else 0.0,
+                "connect_latency_max_seconds": latencies[-1] if latencies else 0.0,
+            }
+
+
+def _shutdown(side, how: int):
+    try:
+        if isinstance(side, socket.socket):
+            side.shutdown(how)
+        elif how == socket.SHUT_WR:
+            side.shutdown_write()
+        else:
+            side.close()
+    except OSError:
+        pass
+
+
+def _pump(source, destination, count: Callable[[int], None]):
+    """Copies from source to destination until source closes.
+
+    A clean EOF is passed on as a half-close, so the other direction can
+    still deliver its response. On an error both sides are shut down to
+    unblock the other direction.
+    """
+    try:
+        while True:
+            data = source.recv(RELAY_CHUNK_SIZE)
+            if not data:
+                break
+            destination.sendall(data)
+            count(len(data))
+    except (OSError, EOFError):
+        for side in (source, destination):
+            _shutdown(side, socket.SHUT_RDWR)
+    else:
+        _shutdown(destination, socket.SHUT_WR)
+
+
+class Tunnel(abc.ABC):
+    """Forwards a local port to a port on the remote host's localhost."""
+
+    def __init__(self, local_port: int, remote_port: int):
+        self.local_port = local_port
+        self.remote_port = remote_port
+        self.stats = TunnelStats()
+        self._listener: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @abc.abstractmethod
+    def open_upstream(self):
+        """Returns a socket-like object connected to the remote port."""
+
+    def start(self):
+        self._listener = socket.create_server(("127.0.0.1", self.local_port))
+        self.local_port = self._listener.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._listener is not None:
+            # shutdown() wakes the accept() in _serve, close() alone doesn't.
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._listener.close()
+            self._listener = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        """True while the tunnel is started and accepting local connections."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self) -> "Tunnel":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                # Listener closed by stop().
+                return
+            threading.Thread(target=self._relay, args=(client,), daemon=True).start()
+
+    def _relay(self, client: socket.socket):
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.monotonic()
+        try:
+            upstream = self.open_upstream()
+        except Exception:
+            client.close()
+            return
+        self.stats.connection_opened(time.monotonic() - start)
+
+        upload = threading.Thread(
+            target=_pump,
+            args=(client, upstream, lambda n: self.stats.add(sent=n)),
+            daemon=True,
+        )
+        upload.start()
+        _pump(upstream, client, lambda n: self.stats.add(received=n))
+        upload.join()
+        client.close()
+        upstream.close()
+        self.stats.connection_closed()
+
+
+class ChannelTunnel(Tunnel):
+    """Tunnel over direct-tcpip channels on an existing paramiko transport."""
+
+    def __init__(self, transport: paramiko.Transport, local_port: int, remote_port: int):
+        super().__init__(local_port, remote_port)
+        self.transport = transport
+
+    def is_alive(self) -> bool:
+        return super().is_alive() and self.transport.is_active()
+
+    def open_upstream(self):
+        return self.transport.open_channel(
+            "direct-tcpip",
+            ("localhost", self.remote_port),
+            ("127.0.0.1", 0),
+            window_size=CHANNEL_WINDOW_SIZE,
+            max_packet_size=CHANNEL_MAX_PACKET_SIZE,
+        )
+
+
+class NativeTunnel(Tunnel):
+    """Tunnel through an OpenSSH subprocess.
+
+    ssh forwards a private local port, and the relay in front of it keeps
+    the public local_port and the counters.
+    """
+
+    def __init__(
+        self,
+        destination: str,
+        local_port: int,
+        remote_port: int,
+        ssh_options: Optional[List[str]] = None,
+        control_path: Optional[str] = None,
+        ready_timeout_seconds: float = 30,
+    ):
+        super().__init__(local_port, remote_port)
+        self.destination = destination
+        self.ssh_options = ssh_options or []
+        self.control_path = control_path
+        self.ready_timeout_seconds = ready_timeout_seconds
+        self.forwarded_port = _free_port()
+        self._process: Optional[subprocess.Popen] = None
+        # Recent ssh stderr, e.g. failed forwards while the WebUI restarts.
+        self.stderr_lines: Deque[str] = collections.deque(maxlen=20)
+        self._stderr_thread: Optional[threading.Thread] = None
+
+    def ssh_command(self) -> List[str]:
+        command = [
+            "ssh",
+            "-N",
+            "-o",
+            # Fail fast on a passphrase or password prompt rather than fight the dashboard for the tty.
+            "BatchMode=yes",
+            "-o",
+            "ExitOnForwardFailure=yes",
+            "-o",
+            "ServerAliveInterval=15",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
+            "-L",
+            f"127.0.0.1:{self.forwarded_port}:localhost:{self.remote_port}",
+        ]
+        if self.control_path is not None:
+            # The first tunnel becomes the master, later ones reuse its connection.
+            command += [
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                f"ControlPath={self.control_path}",
+                "-o",
+                "ControlPersist=no",
+            ]
+        return command + self.ssh_options + [self.destination]
+
+    def start(self):
+        self._process = subprocess.Popen(
+            self.ssh_command(), stdin=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        # ssh blocks once the stderr pipe fills, so keep draining it.
+        self._stderr_thread = threading.Thread(
+            target=self._drain_stderr, args=(self._process.stderr,), daemon=True
+        )
+        self._stderr_thread.start()
+        deadline = time.monotonic() + self.ready_timeout_seconds
+        while not _port_accepting(self.forwarded_port):
+            if self._process.poll() is not None:
+                self._stderr_thread.join()
+                raise TunnelError(
+                    f"ssh exited with {self._process.returncode}: {' '.join(self.stderr_lines)}"
+                )
+            if time.monotonic() >= deadline:
+                self.stop()
+                raise TunnelError(f"ssh forward to port {self.remote_port} didn't come up")
+            time.sleep(0.05)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+        if self._stderr_thread is not None:
+            self._stderr_thread.join()
+            self._stderr_thread = None
+
+    def is_alive(self) -> bool:
+        return super().is_alive() and self._process is not None and self._process.poll() is None
+
+    def _drain_stderr(self, stderr):
+        for line in stderr:
+            self.stderr_lines.append(line.decode(errors="replace").strip())
+        stderr.close()
+
+    def open_upstream(self):
+        upstream = socket.create_connection(("127.0.0.1", self.forwarded_port))
+        upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return upstream
+
+
+class TunnelGroup:
+    """Several tunnels started and stopped together."""
+
+    def __init__(self, tunnels: List[Tunnel]):
+        self.tunnels = tunnels
+
+    def start(self):
+        started = []
+        try:
+            for tunnel in self.tunnels:
+                tunnel.start()
+                started.append(tunnel)
+        except Exception:
+            for tunnel in started:
+                tunnel.stop()
+            raise
+
+    def stop(self):
+        for tunnel in self.tunnels:
+            tunnel.stop()
+
+    def is_alive(self) -> bool:
+        return all(tunnel.is_alive() for tunnel in self.tunnels)
+
+    def __enter__(self) -> "TunnelGroup":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def snapshot(self) -> Dict[int, Dict[str, float]]:
+        """Returns each tunnel's counters keyed by local port."""
+        return {tunnel.local_port: tunnel.stats.snapshot() for tunnel in self.tunnels}
+
+
+def native_tunnels_available() -> bool:
+    return shutil.which("ssh") is not None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _port_accepting(port: int) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+class _StandInServer(paramiko.ServerInterface):
+    """Accepts any client and allows forwarding, standing in for sshd."""
+
+    def get_allowed_auths(self, username):
+        return "none"
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        return paramiko.OPEN_SUCCEEDED
+
+
+def start_stand_in_sshd(sink_port: int) -> paramiko.Transport:
+    """Starts an in-process SSH server that forwards every channel to sink_port.
+
+    Returns a client transport connected and authenticated to it.
+    """
+    server_socket, client_socket = socket.socketpair()
+    server = paramiko.Transport(server_socket)
+    server.add_server_key(paramiko.RSAKey.generate(2048))
+    # Passing an event makes negotiation run in the background, so the client
+    # below can connect.
+    server.start_server(event=threading.Event(), server=_StandInServer())
+
+    def accept_channels():
+        while server.is_active():
+            channel = server.accept(timeout=1)
+            if channel is None:
+                continue
+            upstream = socket.create_connection(("127.0.0.1", sink_port))
+            threading.Thread(
+                target=_pump, args=(upstream, channel, lambda n: None), daemon=True
+            ).start()
+            threading.Thread(
+                target=_pump, args=(channel, upstream, lambda n: None), daemon=True
+            ).start()
+
+    threading.Thread(target=accept_channels, daemon=True).start()
+
+    client = paramiko.Transport(client_socket)
+    client.start_client()
+    client.auth_none("ubuntu")
+    return client
+
+
+def start_bulk_sink(total_bytes: int) -> int:
+    """Starts a server that sends total_bytes to each connection, returns its port."""
+    listener = socket.create_server(("127.0.0.1", 0))
+    payload = os.urandom(RELAY_CHUNK_SIZE)
+
+    def send(connection: socket.socket):
+        with connection:
+            remaining = total_bytes
+            while remaining > 0:
+                chunk = payload[: min(remaining, len(payload))]
+                connection.sendall(chunk)
+                remaining -= len(chunk)
+
+    def serve():
+        while True:
+            connection, _ = listener.accept()
+            threading.Thread(target=send, args=(connection,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def _download(port: int) -> int:
+    received = 0
+    with socket.create_connection(("127.0.0.1", port)) as connection:
+        while True:
+            data = connection.recv(RELAY_CHUNK_SIZE)
+            if not data:
+                return received
+            received += len(data)
+
+
+def benchmark_tunnel(tunnel: Tunnel, connections: int) -> float:
+    """Downloads through tunnel on several connections at once, returns MiB/s."""
+    results: List[int] = []
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=lambda: results.append(_download(tunnel.local_port)))
+        for _ in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(results) / 2**20 / (time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulk transfer through tunnels.")
+    parser.add_argument("--mib", type=int, default=256, help="MiB sent per connection.")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 4])
+    parser.add_argument(
+        "--native-destination",
+        help="Also benchmark a native tunnel to this user@host, e.g. localhost with a real sshd.",
+    )
+    args = parser.parse_args()
+
+    sink_port = start_bulk_sink(args.mib * 2**20)
+    transport = start_stand_in_sshd(sink_port)
+
+    tunnels = [("channel", ChannelTunnel(transport, 0, sink_port))]
+    if args.native_destination:
+        control_path = os.path.join(tempfile.mkdtemp(), "control")
+        tunnels.append(
+            ("native", NativeTunnel(args.native_destination, 0, sink_port, control_path=control_path))
+        )
+
+    for name, tunnel in tunnels:
+        with tunnel:
+            for connections in args.connections:
+                mib_per_second = benchmark_tunnel(tunnel, connections)
+                print(
+                    f"{name:<8} connections={connections:<3} {mib_per_second:8.1f} MiB/s {tunnel.stats.snapshot()}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,350 @@
-import curses
+from typing import Deque, Dict, List, Optional, Tuple, Union
+import collections
+import math
+import sys
+import threading
+import time
+import traceback
+
 import urwid
 
+from health import mean_time_to_recovery
+from webui import StateMachine, WebUIStatus
 
-class Screen:
-    def __init__(self, stdscr):
-        self.stdscr = stdscr
-
-    def tick(self):
-        self.stdscr.clear()
-        rows, cols = self.stdscr.getmaxyx()
-        x = (cols - len("Hello World!")) // 2
-        y = rows // 2
-        self.stdscr.addstr(y, x, "Hello World!")
-        self.stdscr.addstr(0, 0, str(curses.LINES))
-        self.stdscr.refresh()
-
-
-def main(stdscr):
-    # Clear screen
-    screen = Screen(stdscr)
-    while True:
-        
-        #window = curses.newwin(10, curses.COLS, 0, 0)
-        #window.clear()
-        #window.addstr(0, 0, "Hello World!")
-
-        #stdscr.refresh()
-        #window.refresh()
-        screen.tick()
-        code = stdscr.getch()
-        #if code == curses.KEY_RESIZE:
-            #curses.endwin()
-            #stdscr = curses.initscr()
-            #stdscr.refresh()
-            #stdscr.clear()
-            #screen = Screen(stdscr)
 
+PALETTE = [
+    ("banner", "black", "light gray"),
+    ("good", "dark green", ""),
+    ("bad", "dark red", ""),
+]
 
-if __name__ == "__main__":
-    #curses.wrapper(main)
-    def exit_on_q(key):
-        if key in ('q', 'Q'):
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    return f"{minutes}m{seconds:02d}s"
+
+
+def format_value(value: Optional[float], fmt: str = ".1f") -> str:
+    if value is None or math.isnan(value):
+        return "-"
+    return format(value, fmt)
+
+
+class LogBuffer:
+    """File-like sink that keeps the last lines written to it.
+
+    Stands in for stdout and stderr while the dashboard owns the terminal,
+    so prints from the state machine and fabric end up in the dashboard.
+    """
+
+    def __init__(self, max_lines: int = 200):
+        self.lines: Deque[str] = collections.deque(maxlen=max_lines)
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            *complete, self._partial = (self._partial + text).split("\n")
+            self.lines.extend(line.rstrip("\r") for line in complete)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+    def tail(self, count: int) -> List[str]:
+        with self._lock:
+            return list(self.lines)[-count:]
+
+
+class Dashboard:
+    """Terminal dashboard showing a StateMachine while it runs.
+
+    The state machine runs on a worker thread and the WebUI log is fetched
+    on another, so slow SSH calls never block the UI. The screen is only
+    refreshed every refresh_interval_seconds, and only widgets whose text
+    changed are updated, which keeps redraws cheap over slow connections.
+
+    Keys: q to stop and quit, t to terminate the instance.
+    """
+
+    def __init__(
+        self,
+        state_machine: StateMachine,
+        refresh_interval_seconds: float = 0.5,
+        log_poll_interval_seconds: float = 2.0,
+        log_lines: int = 15,
+    ):
+        self.state_machine = state_machine
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.log_poll_interval_seconds = log_poll_interval_seconds
+        self.log_lines = log_lines
+
+        self.messages = LogBuffer()
+        self.webui_log: List[str] = []
+        # Key press waiting on the current phase, shown so the UI doesn't look hung.
+        self.pending_action: Optional[str] = None
+        # Last (time, total, rate) of each counter shown as a rate.
+        self._rates: Dict[str, Tuple[float, float, float]] = {}
+        self._stopped = threading.Event()
+        self._markup: Dict[str, Union[str, list]] = {}
+
+        self.texts: Dict[str, urwid.Text] = {
+            name: urwid.Text("")
+            for name in [
+                "status",
+                "phases",
+                "probes",
+                "throughput",
+                "gpu",
+                "messages",
+                "webui_log",
+            ]
+        }
+        header = urwid.AttrMap(
+            urwid.Text(" Stable Diffusion WebUI on LambdaLabs  (q: quit, t: terminate)"),
+            "banner",
+        )
+        body = urwid.Pile(
+            [
+                ("pack", urwid.Columns(
+                    [
+                        urwid.LineBox(self.texts["status"], title="Status"),
+                        urwid.LineBox(self.texts["phases"], title="Phases"),
+                        urwid.LineBox(self.texts["probes"], title="Probes"),
+                    ]
+                )),
+                ("pack", urwid.Columns(
+                    [
+                        urwid.LineBox(self.texts["gpu"], title="Instance"),
+                        urwid.LineBox(self.texts["throughput"], title="Throughput"),
+                    ]
+                )),
+                ("pack", urwid.LineBox(self.texts["messages"], title="Messages")),
+                urwid.LineBox(
+                    urwid.Filler(self.texts["webui_log"], valign="bottom"),
+                    title="WebUI log",
+                ),
+            ]
+        )
+        self.frame = urwid.Frame(body, header=header)
+
+    def run(self):
+        # Create the screen before stdout is redirected so it keeps the terminal.
+        screen = urwid.raw_display.Screen()
+        self.loop = urwid.MainLoop(
+            self.frame, PALETTE, screen=screen, unhandled_input=self._handle_input
+        )
+
+        worker = threading.Thread(target=self._run_state_machine, daemon=True)
+        log_poller = threading.Thread(target=self._poll_webui_log, daemon=True)
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.messages
+        try:
+            worker.start()
+            log_poller.start()
+            self.loop.set_alarm_in(0, self._refresh, worker)
+            self.loop.run()
+        finally:
+            self._stopped.set()
+            self.state_machine.stop()
+            sys.stdout, sys.stderr = stdout, stderr
+
+        for line in self.messages.tail(self.log_lines):
+            print(line)
+
+    def _run_state_machine(self):
+        try:
+            self.state_machine.run()
+        except SystemExit:
+            pass
+        except Exception:
+            traceback.print_exc()
+
+    def _poll_webui_log(self):
+        while not self._stopped.wait(self.log_poll_interval_seconds):
+            if self.state_machine.state.status not in (
+                WebUIStatus.INSTALLING,
+                WebUIStatus.STARTING,
+                WebUIStatus.RUNNING,
+            ):
+                continue
+            # Only the state machine thread connects, so this never races it
+            # to open a connection, e.g. to an instance being replaced.
+            webui = self.state_machine.connected_webui
+            if webui is None:
+                continue
+            try:
+                self.webui_log = webui.log_tail(self.log_lines)
+            except Exception as e:
+                self.webui_log = [f"Failed to fetch WebUI log: {e}"]
+
+    def _handle_input(self, key):
+        if key in ("q", "Q"):
+            self.pending_action = self._after_phase("stop")
+            print(f"{self.pending_action.capitalize()}...")
+            self.state_machine.stop()
+        elif key in ("t", "T"):
+            self.pending_action = self._after_phase("terminate")
+            print(f"{self.pending_action.capitalize()}...")
+            self.state_machine.terminate_requested = True
+
+    def _after_phase(self, action: str) -> str:
+        # Only the running state checks for stop and terminate requests, other
+        # phases finish their current wait first.
+        status = self.state_machine.state.status
+        if status in (WebUIStatus.RUNNING, WebUIStatus.TERMINATING):
+            return f"will {action} now"
+        return f"will {action} after {status.value} finishes"
+
+    def _refresh(self, loop, worker: threading.Thread):
+        if not worker.is_alive():
             raise urwid.ExitMainLoop()
 
-    palette = [
-        ('banner', 'black', 'light gray'),
-        ('streak', 'black', 'dark red'),
-        ('bg', 'black', 'dark blue'),]
-
-    txt = urwid.Text(('banner', u" Hello World "), align='center')
-    map1 = urwid.AttrMap(txt, 'streak')
-    fill = urwid.Filler(map1)
-    map2 = urwid.AttrMap(fill, 'bg')
-    loop = urwid.MainLoop(map2, palette, unhandled_input=exit_on_q)
-    loop.run()
\ No newline at end of file
+        self._set("status", self._status_text())
+        self._set("phases", self._phases_text())
+        self._set("probes", self._probes_text())
+        self._set("gpu", self._gpu_text())
+        self._set("throughput", self._throughput_text())
+        self._set("messages", "\n".join(self.messages.tail(6)))
+        self._set("webui_log", "\n".join(self.webui_log))
+
+        loop.set_alarm_in(self.refresh_interval_seconds, self._refresh, worker)
+
+    def _set(self, name: str, markup):
+        # Only touch widgets whose content changed, so urwid redraws as little as possible.
+        if self._markup.get(name) != markup:
+            self._markup[name] = markup
+            self.texts[name].set_text(markup)
+
+    def _rate(self, name: str, total: float) -> float:
+        """Returns the per second rate of a cumulative counter since the last refresh."""
+        now = time.monotonic()
+        previous_time, previous_total, rate = self._rates.get(name, (now, total, 0.0))
+        if now > previous_time:
+            rate = (total - previous_total) / (now - previous_time)
+        self._rates[name] = (now, total, rate)
+        return rate
+
+    def _status_text(self) -> str:
+        state = self.state_machine.state
+        cost = self.state_machine.cost_dollars
+        recoveries = self.state_machine.recoveries
+        if state.failure_time is not None:
+            recovery = f"{state.failure_kind} {format_duration(time.time() - state.failure_time)} ago"
+        else:
+            mttr = mean_time_to_recovery(recoveries)
+            recovery = f"{len(recoveries)} (MTTR {format_duration(mttr) if mttr is not None else '-'})"
+        return "\n".join(
+            [
+                f"Status:   {state.status.value}",
+                f"Instance: {state.current_instance or '-'}",
+                f"Type:     {state.instance_type or '-'}",
+                f"Profile:  {state.launch_profile or '-'}",
+                f"Cost:     ${format_value(cost, '.2f')}",
+                f"Recovery: {recovery}",
+            ]
+            + ([f"Pending:  {self.pending_action}"] if self.pending_action else [])
+        )
+
+    def _phases_text(self) -> str:
+        durations = dict(self.state_machine.phase_durations)
+        current = self.state_machine.state.status
+        durations[current] = (
+            durations.get(current, 0.0) + self.state_machine.phase_elapsed_seconds
+        )
+        return "\n".join(
+            f"{status.value:<18} {format_duration(seconds)}"
+            for status, seconds in durations.items()
+        )
+
+    def _probes_text(self) -> Union[str, list]:
+        probes = dict(self.state_machine.probes)
+        if not probes:
+            return "-"
+        markup: list = []
+        for name, ok in probes.items():
+            markup += [f"{name:<11}", ("good", "yes\n") if ok else ("bad", "no\n")]
+        return markup
+
+    def _gpu_text(self) -> str:
+        sample = self.state_machine.metrics.latest()
+        if sample is None:
+            return "No metrics yet"
+        return "\n".join(
+            [
+                f"GPU:  {format_value(sample['gpu_utilization_percent'], '.0f')}%  "
+                f"{format_value(sample['gpu_power_watts'], '.0f')} W",
+                f"VRAM: {format_value(sample['gpu_memory_used_mib'] / 1024)}"
+                f" / {format_value(sample['gpu_memory_total_mib'] / 1024)} GiB",
+                f"CPU:  {format_value(sample['cpu_utilization_percent'], '.0f')}%",
+                f"RAM:  {format_value(sample['memory_used_mib'] / 1024)}"
+                f" / {format_value(sample['memory_total_mib'] / 1024)} GiB",
+                f"Disk: {format_value(sample['disk_used_gib'])} GiB used",
+                f"Bottleneck: {self.state_machine.metrics.bottleneck()}",
+            ]
+        )
+
+    def _throughput_text(self) -> str:
+        lines = []
+        sample = self.state_machine.metrics.latest()
+        if sample is not None:
+            lines += [
+                f"Network in:  {format_value(sample['network_rx_bytes_per_second'] / 2**20)} MiB/s",
+                f"Network out: {format_value(sample['network_tx_bytes_per_second'] / 2**20)} MiB/s",
+                f"Disk write:  {format_value(sample['disk_write_bytes_per_second'] / 2**20)} MiB/s",
+            ]
+
+        tunnels = self.state_machine.tunnels
+        if tunnels is not None:
+            for port, stats in tunnels.snapshot().items():
+                rate = self._rate(f"tunnel-{port}", stats["bytes_received"] + stats["bytes_sent"])
+                lines.append(
+                    f"Tunnel {port}: {format_value(rate / 2**20)} MiB/s, "
+                    f"{stats['active_connections']} open, "
+                    f"connect {format_value(stats['connect_latency_p50_seconds'] * 1000, '.0f')} ms"
+                )
+
+        output_sync = self.state_machine.output_sync
+        if output_sync is not None:
+            rate = self._rate("output_sync", output_sync.bytes_transferred)
+            lines += [
+                f"Output sync: {format_value(rate / 2**20)} MiB/s",
+                f"Synced:      {output_sync.files_transferred} files, "
+                f"{format_value(output_sync.bytes_transferred / 2**20)} MiB",
+            ]
+        postprocessor = self.state_machine.postprocessor
+        if postprocessor is not None:
+            encode = postprocessor.timings.get("total")
+            lines.append(
+                f"Post-processing: {postprocessor.pending} pending, "
+                f"{format_value(encode.mean_seconds if encode else None, '.1f')}s per clip"
+            )
+
+        result_cache = self.state_machine.result_cache
+        if result_cache is not None:
+            lines.append(
+                f"Result cache: {result_cache.hits} hits, {result_cache.misses} misses, "
+                f"{format_value(result_cache.total_bytes / 2**20)} MiB"
+            )
+        return "\n".join(lines) or "-"
+
+
+def main():
+    state_machine = StateMachine()
+    # Choosing an instance type is interactive, so do it before the dashboard
+    # takes over the terminal.
+    while state_machine.state.status == WebUIStatus.UNKNOWN:
+        state_machine.step()
+    Dashboard(state_machine).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,87 @@
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional
+import json
 import sys
+import tempfile
+import threading
 import time
 import os
 import enum
 import fabric
+import paramiko
 
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from dataclasses_json import DataClassJsonMixin
 
-from lambda_labs import InstanceID
+from lambda_labs import InstanceID, InstanceTypeName
 
 from tmux import Tmux, TmuxSession
-from remote import RemoteHost
-
-from lambda_labs import LambdaAPI, STATUS_ACTIVE
+from remote import (
+    RemoteHost,
+    fetch_host_key_with_retries,
+    is_tcp_port_open,
+    open_with_retries,
+    pin_host_key,
+    wait_for_tcp_port,
+)
+from output_sync import OutputSync
+from postprocess import DEFAULT_STEPS, PostProcessor, Step
+from metrics import MetricsBuffer, MetricsSampler
+from tunnel import (
+    MODE_CHANNEL,
+    MODE_NATIVE,
+    ChannelTunnel,
+    NativeTunnel,
+    Tunnel,
+    TunnelError,
+    TunnelGroup,
+    native_tunnels_available,
+)
+from models import (
+    KIND_TEXT2VIDEO,
+    MODELSCOPE_MODEL_PATH,
+    ModelManager,
+    ModelManifest,
+    load_manifest,
+)
+
+from lambda_labs import InstanceDetails, LambdaAPI, LambdaAPIError, RegionName, SSHKey, STATUS_ACTIVE
 
 from instances import prompt_user_for_instance_type
+from result_cache import CachingProxy, ResultCache
+from race import InstanceRace, get_race_regions, save_race_result
+from health import (
+    INSTANCE_DOWN,
+    RECOVERY_KIND_REPLACE,
+    RECOVERY_KIND_RESTART,
+    HealthSupervisor,
+    Recovery,
+    load_recoveries,
+    mean_time_to_recovery,
+    save_recovery,
+)
+from launch_profiles import DEFAULT_PROFILE, LaunchProfile, select_launch_profile
 
 
 WEBUI_INSTALL_COMMAND = "bash <(wget -qO- https://raw.githubusercontent.com/AUTOMATIC1111/stable-diffusion-webui/master/webui.sh)"
 WEBUI_DIRECTORY = "/home/ubuntu/stable-diffusion-webui"
 WEBUI_SCRIPT = os.path.join(WEBUI_DIRECTORY, "webui.sh")
+WEBUI_USER_SCRIPT = os.path.join(WEBUI_DIRECTORY, "webui-user.sh")
+WEBUI_OUTPUTS_DIRECTORY = os.path.join(WEBUI_DIRECTORY, "outputs")
+# Host keys of our instances, kept out of ~/.ssh/known_hosts since
+# LambdaLabs reuses IPs between instances.
+KNOWN_HOSTS_FILE = "known_hosts"
+# Records the launch config of the running WebUI so we can reattach to it.
+WEBUI_LAUNCH_CONFIG_FILE = os.path.join(WEBUI_DIRECTORY, ".launch-config")
+
+# Tiny txt2img request used to warm up the model after launch.
+WARM_UP_TXT2IMG_REQUEST = {
+    "prompt": "warm up",
+    "steps": 1,
+    "width": 64,
+    "height": 64,
+    "batch_size": 1,
+}
 
 # Installed
 # Started but not accessible
@@ -52,6 +113,15 @@ class WebUIState(DataClassJsonMixin):
     status: WebUIStatus = WebUIStatus.UNKNOWN
     current_instance: Optional[InstanceID] = None
     creation_time: Optional[float] = None
+    instance_type: Optional[InstanceTypeName] = None
+    price_cents_per_hour: Optional[int] = None
+    # Instances launched speculatively in race mode, until a winner is picked.
+    race_instances: List[InstanceID] = field(default_factory=list)
+    launch_profile: Optional[str] = None
+    # Set while recovering from a failure, cleared once the WebUI runs again.
+    failure_time: Optional[float] = None
+    failure_kind: Optional[str] = None
+    failed_instance: Optional[InstanceID] = None
 
 
 def save_state(state: WebUIState) -> None:
@@ -81,16 +151,35 @@ def build_connect_kwargs() -> Dict[str, str]:
     return {"key_filename": get_ssh_private_key_path()}
 
 
+def build_connection_config() -> fabric.Config:
+    # Remote commands never need our stdin. Without this every run() starts a
+    # thread reading the local terminal, which steals keypresses from the dashboard.
+    return fabric.Config(overrides={"run": {"in_stream": False}})
+
+
+def known_hosts_ssh_options() -> List[str]:
+    """Options making OpenSSH check host keys against KNOWN_HOSTS_FILE."""
+    return ["-o", f"UserKnownHostsFile={os.path.abspath(KNOWN_HOSTS_FILE)}"]
+
+
 class WebUIError(Exception):
     pass
 
 
-MODEL_SCOPE_URLS = [
-    "https://huggingface.co/damo-vilab/modelscope-damo-text-to-video-synthesis/resolve/main/VQGAN_autoencoder.pth",
-    "https://huggingface.co/damo-vilab/modelscope-damo-text-to-video-synthesis/resolve/main/configuration.json",
-    "https://huggingface.co/damo-vilab/modelscope-damo-text-to-video-synthesis/resolve/main/open_clip_pytorch_model.bin",
-    "https://huggingface.co/damo-vilab/modelscope-damo-text-to-video-synthesis/resolve/main/text2video_pytorch_model.pth",
-]
+def wait_for(
+    predicate: Callable[[], bool], timeout_seconds: float, poll_interval_seconds: float
+) -> bool:
+    """Polls predicate until it returns True or timeout_seconds elapses.
+
+    Returns True if the predicate became True before the timeout.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        if predicate():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll_interval_seconds)
 
 
 class WebUI:
@@ -102,25 +191,82 @@ class WebUI:
     TMUX_SESSION_NAME = "stable-diffusion"
     TMUX_WEBUI_WINDOW_INDEX = 0
     WEBUI_PORT = 7860
+    # A wedged first generation fails the warm up rather than blocking starting.
+    WARM_UP_TIMEOUT_SECONDS = 300
     WEBUI_PROCESS_NAME = "python3 launch.py"
     WEBUI_INSTANCE_NAME = "stable-diffusion-webui"
 
-    MODELSCOPE_MODEL_PATH = (
-        "/home/ubuntu/stable-diffusion-webui/models/text2video/modelscope"
-    )
+    MODELSCOPE_MODEL_PATH = MODELSCOPE_MODEL_PATH
 
-    def __init__(self, conn: fabric.Connection):
+    def __init__(
+        self,
+        conn: fabric.Connection,
+        profile: LaunchProfile = DEFAULT_PROFILE,
+        manifest: Optional[ModelManifest] = None,
+    ):
         self.conn = conn
+        self.profile = profile
         self.host = RemoteHost(conn)
+        self.models = ModelManager(conn, manifest or load_manifest())
         self.tmux = Tmux(conn)
         self.session = self.tmux.find_or_create_sesssion(self.TMUX_SESSION_NAME)
         self.session.select_window(self.TMUX_WEBUI_WINDOW_INDEX)
 
-    def forward_port(self):
-        return self.conn.forward_local(self.WEBUI_PORT)
+    def forward_port(
+        self, mode: Optional[str] = None, local_ports: Optional[List[int]] = None
+    ) -> TunnelGroup:
+        """Returns tunnels forwarding each of local_ports to the WebUI port.
+
+        Uses native OpenSSH tunnels sharing one ControlMaster connection when
+        ssh is available, otherwise channels on the existing connection.
+        """
+        if mode is None:
+            mode = MODE_NATIVE if native_tunnels_available() else MODE_CHANNEL
+        local_ports = local_ports or [self.WEBUI_PORT]
+
+        tunnels: List[Tunnel] = []
+        if mode == MODE_NATIVE:
+            control_path = os.path.join(
+                tempfile.gettempdir(), f"lambda-sd-webui-{self.conn.host}.sock"
+            )
+            for local_port in local_ports:
+                tunnels.append(
+                    NativeTunnel(
+                        f"{self.conn.user}@{self.conn.host}",
+                        local_port,
+                        self.WEBUI_PORT,
+                        ssh_options=["-i", get_ssh_private_key_path()] + known_hosts_ssh_options(),
+                        control_path=control_path,
+                    )
+                )
+        else:
+            self.conn.open()
+            transport = self.conn.client.get_transport()
+            for local_port in local_ports:
+                tunnels.append(ChannelTunnel(transport, local_port, self.WEBUI_PORT))
+        return TunnelGroup(tunnels)
+
+    def output_sync(
+        self,
+        local_directory: str,
+        on_transferred: Optional[Callable[[str], None]] = None,
+    ) -> OutputSync:
+        """Returns a syncer copying the WebUI outputs directory to local_directory."""
+        return OutputSync(
+            self.conn,
+            WEBUI_OUTPUTS_DIRECTORY,
+            local_directory,
+            on_transferred=on_transferred,
+        )
+
+    def metrics_sampler(
+        self, buffer: MetricsBuffer, interval_seconds: float = 1.0
+    ) -> MetricsSampler:
+        """Returns a sampler streaming GPU and host metrics into buffer."""
+        return MetricsSampler(self.conn, interval_seconds, buffer)
 
     def open_terminal(self):
-        self.session.open_terminal()
+        self.session.open_terminal(ssh_options=known_hosts_ssh_options())
 
     def install_webui(self):
         if self.is_webui_installed():
@@ -128,20 +274,25 @@ class WebUI:
         self.session.run_command_in_window(0, WEBUI_INSTALL_COMMAND)
 
     def install_text2video_extension(self):
-        self.conn.run(
-            "git clone https://github.com/kabachuha/sd-webui-text2video.git /home/ubuntu/stable-diffusion-webui/extensions/sd-webui-text2video"
-        )
-        self.conn.run(
-            "/home/ubuntu/stable-diffusion-webui/venv/bin/pip install imageio_ffmpeg av moviepy numexpr"
-        )
-        self.conn.run(f"mkdir -p {self.MODELSCOPE_MODEL_PATH}")
-        for url in MODEL_SCOPE_URLS:
-            self.conn.run(f"cd {self.MODELSCOPE_MODEL_PATH} && wget -nc --progress=dot:giga {url}")
+        if not self.host.directory_exists(
+            "/home/ubuntu/stable-diffusion-webui/extensions/sd-webui-text2video/.git"
+        ):
+            self.conn.run(
+                "git clone https://github.com/kabachuha/sd-webui-text2video.git /home/ubuntu/stable-diffusion-webui/extensions/sd-webui-text2video"
+            )
+            self.conn.run(
+                "/home/ubuntu/stable-diffusion-webui/venv/bin/pip install imageio_ffmpeg av moviepy numexpr"
+            )
+        self.install_models()
+
+    def install_models(self):
+        """Fetches any models in the manifest that aren't on the instance."""
+        self.models.sync()
 
     def is_text2video_extension_installed(self) -> bool:
         return self.host.directory_exists(
             "/home/ubuntu/stable-diffusion-webui/extensions/sd-webui-text2video/.git"
-        ) and self.host.directory_exists(self.MODELSCOPE_MODEL_PATH)
+        ) and self.models.is_complete(KIND_TEXT2VIDEO)
 
     def is_webui_installed(self) -> bool:
         """Returns True if WebUI has been cloned into the expected directory."""
@@ -155,13 +306,49 @@ class WebUI:
         """Returns True if the main WebUI process is currently running."""
         return self.host.is_process_running(self.WEBUI_PROCESS_NAME)
 
+    @property
+    def launch_config(self) -> str:
+        """The command line the WebUI should be running with."""
+        return f"{WEBUI_SCRIPT} {self.profile.commandline}"
+
+    def running_launch_config(self) -> Optional[str]:
+        """Returns the launch config recorded by the last call to run()."""
+        return self.host.read_file(WEBUI_LAUNCH_CONFIG_FILE)
+
+    def is_webui_healthy(self) -> bool:
+        """Returns True if WebUI is running, serving and matches the desired launch config."""
+        return (
+            self.is_webui_running()
+            and self.is_webui_accessible()
+            and self.running_launch_config() == self.launch_config
+        )
+
     def run(self):
         """Starts the WebUI in the first tmux window."""
+        self.host.write_file(WEBUI_USER_SCRIPT, self.profile.webui_user_script())
+        self.host.write_file(WEBUI_LAUNCH_CONFIG_FILE, self.launch_config)
         self.session.run_command_in_window(0, WEBUI_SCRIPT)
 
-    def kill(self):
-        """Terminates any running WebUI"""
-        self.conn.run("pkill -f launch.py", warn=True, hide=True)
+    def warm_up(self) -> bool:
+        """Runs a tiny generation so the first real request isn't slow.
+
+        Returns True if the warm up generation succeeded.
+        """
+        return self.host.localhost_http_post_json(
+            self.WEBUI_PORT,
+            "/sdapi/v1/txt2img",
+            json.dumps(WARM_UP_TXT2IMG_REQUEST),
+            self.WARM_UP_TIMEOUT_SECONDS,
+        )
+
+    def log_tail(self, lines: int = 50) -> List[str]:
+        """Returns the last lines of WebUI output from its tmux window."""
+        return self.session.capture_window(self.TMUX_WEBUI_WINDOW_INDEX, lines)
+
+    def kill(self, force: bool = False):
+        """Terminates any running WebUI, with SIGKILL if force is set"""
+        signal_option = "-9 " if force else ""
+        self.conn.run(f"pkill {signal_option}-f launch.py", warn=True, hide=True)
 
 
 class StateMachine:
@@ -170,15 +357,78 @@ class StateMachine:
     instance_name: str = "stable-diffusion-webui"
     running: bool = False
     new_instance_poll_interval_seconds: int = 5
+    race_poll_interval_seconds: float = 2
+    ssh_ready_timeout_seconds: int = 300
     installing_poll_interval_seconds: int = 5
+    webui_stop_timeout_seconds: int = 30
+    webui_start_timeout_seconds: int = 600
+    webui_poll_interval_seconds: float = 0.5
     state: WebUIState
     ssh_username: str = "ubuntu"
     terminal_opened: bool = False
-
-    def __init__(self, state: Optional[WebUIState] = None):
+    # Generated outputs are copied to <output_directory>/<instance id>.
+    output_directory: str = "outputs"
+    metrics_interval_seconds: float = 1.0
+    # Extra local ports can be added to spread connections over more tunnels.
+    tunnel_local_ports: List[int] = [WebUI.WEBUI_PORT]
+    # API clients using this port get repeated generations from the local cache.
+    result_cache_port: int = 7861
+    result_cache_directory: str = "cache"
+    # Steps run locally over each text2video clip as it's synced, empty to disable.
+    postprocess_steps: List[Step] = DEFAULT_STEPS
+    # Longest to spend copying outputs off an instance before terminating it anyway.
+    final_flush_timeout_seconds: float = 600
+    health_check_interval_seconds: float = 15
+    # Consecutive failed health checks before restarting or replacing.
+    health_failure_threshold: int = 3
+    # How long the caching proxy holds API requests while recovering.
+    requeue_timeout_seconds: float = 1800
+
+    def __init__(
+        self,
+        state: Optional[WebUIState] = None,
+        launch_profile: Optional[str] = None,
+        race_count: Optional[int] = None,
+    ):
         if state is None:
             state = load_state()
         self.state = state
+        # Overrides automatic launch profile selection, e.g. WEBUI_LAUNCH_PROFILE=a100-80gb
+        self.launch_profile = launch_profile or os.environ.get("WEBUI_LAUNCH_PROFILE")
+        # Launch this many instances across regions and keep the first ready,
+        # e.g. WEBUI_RACE_COUNT=3. Racing is off by default.
+        self.race_count = race_count or int(os.environ.get("WEBUI_RACE_COUNT", "1"))
+        self.metrics = MetricsBuffer()
+        self.metrics_sampler: Optional[MetricsSampler] = None
+        self.output_sync: Optional[OutputSync] = None
+        # "native" or "channel", picked automatically if not set, e.g. WEBUI_TUNNEL_MODE=channel
+        self.tunnel_mode = os.environ.get("WEBUI_TUNNEL_MODE")
+        self.tunnels: Optional[TunnelGroup] = None
+        self.result_cache: Optional[ResultCache] = None
+        # Outlives the running state so API requests survive a recovery.
+        self.caching_proxy: Optional[CachingProxy] = None
+        # Every recovery so far, across sessions, for mean time to recovery.
+        self.recoveries: List[Recovery] = load_recoveries()
+        self.postprocessor: Optional[PostProcessor] = None
+        # Latest result of each WebUI probe, e.g. {"accessible": True}.
+        self.probes: Dict[str, bool] = {}
+        # Seconds spent in each status during this session.
+        self.phase_durations: Dict[WebUIStatus, float] = {}
+        self.phase_started = time.monotonic()
+        # Set to leave the running state and terminate the instance.
+        self.terminate_requested = False
+
+    @property
+    def phase_elapsed_seconds(self) -> float:
+        return time.monotonic() - self.phase_started
+
+    @property
+    def cost_dollars(self) -> Optional[float]:
+        """Cost of the current instance so far, if it's known."""
+        if self.state.creation_time is None or self.state.price_cents_per_hour is None:
+            return None
+        hours = (time.time() - self.state.creation_time) / 3600
+        return hours * self.state.price_cents_per_hour / 100
 
     @property
     def webui(self) -> WebUI:
@@ -190,16 +440,49 @@ class StateMachine:
                 details.ip,
                 user=self.ssh_username,
                 connect_kwargs=build_connect_kwargs(),
+                config=build_connection_config(),
             )
-            self._webui = WebUI(connection)
+            if os.path.exists(KNOWN_HOSTS_FILE):
+                connection.client.load_host_keys(KNOWN_HOSTS_FILE)
+            open_with_retries(connection, self.ssh_ready_timeout_seconds)
+            profile = select_launch_profile(details.instance_type, self.launch_profile)
+            self.info(
+                f"Using launch profile {profile.name} for {details.instance_type.name}: {profile.commandline}"
+            )
+            self.state.instance_type = details.instance_type.name
+            self.state.launch_profile = profile.name
+            save_state(self.state)
+            self._webui = WebUI(connection, profile)
+            # Sample from as soon as SSH is up, so installs and model downloads show up too.
+            self.metrics_sampler = self._webui.metrics_sampler(
+                self.metrics, self.metrics_interval_seconds
+            )
+            self.metrics_sampler.start()
         return self._webui
 
+    @property
+    def connected_webui(self) -> Optional[WebUI]:
+        """The WebUI if a connection is already open, for other threads that mustn't connect."""
+        return self._webui
+
+    def _close_webui(self):
+        """Drops the connection to the current instance, e.g. before replacing it."""
+        if self.metrics_sampler is not None:
+            self.metrics_sampler.stop()
+            self.metrics_sampler = None
+        self._webui = None
+        self.terminal_opened = False
+
     def reset_state(self):
         self.state = WebUIState()
         save_state(self.state)
 
     def _transition_status(self, new_status: WebUIStatus):
         self.info(f"Transitioned from {self.state.status} to {new_status}.")
+        self.phase_durations[self.state.status] = (
+            self.phase_durations.get(self.state.status, 0.0) + self.phase_elapsed_seconds
+        )
+        self.phase_started = time.monotonic()
         self.state.status = new_status
         save_state(self.state)
 
@@ -209,20 +492,38 @@ class StateMachine:
 
         self.running = True
         while self.running:
-            if self.state.status == WebUIStatus.UNKNOWN:
-                self._status_unknown()
-            elif self.state.status == WebUIStatus.CREATING_INSTANCE:
-                self._status_creating_instance()
-            elif self.state.status == WebUIStatus.INSTALLING:
-                self._status_installing()
-            elif self.state.status == WebUIStatus.STARTING:
-                self._status_starting()
-            elif self.state.status == WebUIStatus.RUNNING:
-                self._status_running()
-            elif self.state.status == WebUIStatus.TERMINATING:
-                self._status_terminating()
-            else:
+            if not self.step():
                 break
+            # Honour a terminate request made mid-phase instead of carrying on to running.
+            if (
+                self.terminate_requested
+                and self.state.current_instance
+                and not self.state.race_instances
+                and self.state.status in (WebUIStatus.INSTALLING, WebUIStatus.STARTING)
+            ):
+                self._transition_status(WebUIStatus.TERMINATING)
+
+    def stop(self):
+        """Asks a running StateMachine to stop once the current status yields."""
+        self.running = False
+
+    def step(self) -> bool:
+        """Runs the handler for the current status, returns False if there's none."""
+        if self.state.status == WebUIStatus.UNKNOWN:
+            self._status_unknown()
+        elif self.state.status == WebUIStatus.CREATING_INSTANCE:
+            self._status_creating_instance()
+        elif self.state.status == WebUIStatus.INSTALLING:
+            self._status_installing()
+        elif self.state.status == WebUIStatus.STARTING:
+            self._status_starting()
+        elif self.state.status == WebUIStatus.RUNNING:
+            self._status_running()
+        elif self.state.status == WebUIStatus.TERMINATING:
+            self._status_terminating()
+        else:
+            return False
+        return True
 
     def _status_unknown(self):
         instances = self.lapi.get_instances()
@@ -234,26 +535,48 @@ class StateMachine:
             raise WebUIError("Instance exists and is already running.")
 
         chosen_offer = prompt_user_for_instance_type(self.lapi)
+        local_ssh_keys = self._local_ssh_keys()
 
-        ssh_keys = self.lapi.get_ssh_keys()
-        if not ssh_keys:
-            raise WebUIError(
-                "No SSH keys found. Please create an SSH key and try again."
-            )
+        instance_type_name = chosen_offer.instance_type.name
+        self.state.creation_time = time.time()
+        self.state.price_cents_per_hour = chosen_offer.instance_type.price_cents_per_hour
 
-        pub_key = get_ssh_public_key()
-        local_ssh_keys = [key for key in ssh_keys if key.public_key == pub_key]
-
-        if not local_ssh_keys:
-            raise WebUIError(f"Local SSH key {pub_key} doesn't match any LambdaLabs keys.")
+        region_names = (
+            get_race_regions(self.lapi, instance_type_name, self.race_count)
+            if self.race_count > 1
+            else []
+        )
+        if self.race_count > 1 and not region_names:
+            self.info("No regions left with capacity to race in, launching a single instance.")
+        if region_names:
+            self.info(
+                f"Racing {len(region_names)} LambdaLabs instances of type {instance_type_name} in {', '.join(region_names)}"
+            )
+            self.state.race_instances = []
+            lock = threading.Lock()
+
+            def launch(region_name: RegionName):
+                instance_id = self._launch_instance(instance_type_name, region_name, local_ssh_keys)
+                if instance_id is not None:
+                    # Saved straight away so a later failure can't lose a billing instance.
+                    with lock:
+                        self.state.race_instances.append(instance_id)
+                        save_state(self.state)
+
+            with ThreadPoolExecutor(max_workers=len(region_names)) as executor:
+                list(executor.map(launch, region_names))
+            if not self.state.race_instances:
+                raise WebUIError("Failed to launch any instances to race.")
+            self._transition_status(WebUIStatus.CREATING_INSTANCE)
+            return
 
         region_name = chosen_offer.regions_with_capacity_available[0].name
         self.info(
-            f"Launching LambdaLabs instance named {self.instance_name} of type {chosen_offer.instance_type.name} in {region_name}"
+            f"Launching LambdaLabs instance named {self.instance_name} of type {instance_type_name} in {region_name}"
         )
         instance_id = self.lapi.launch_instance(
             name=self.instance_name,
-            instance_type_name=chosen_offer.instance_type.name,
+            instance_type_name=instance_type_name,
             region_name=region_name,
             ssh_keys=local_ssh_keys,
         )
@@ -261,14 +584,98 @@ class StateMachine:
         self.state.current_instance = instance_id
         self._transition_status(WebUIStatus.CREATING_INSTANCE)
 
+    def _local_ssh_keys(self) -> List[SSHKey]:
+        ssh_keys = self.lapi.get_ssh_keys()
+        if not ssh_keys:
+            raise WebUIError(
+                "No SSH keys found. Please create an SSH key and try again."
+            )
+
+        pub_key = get_ssh_public_key()
+        local_ssh_keys = [key for key in ssh_keys if key.public_key == pub_key]
+
+        if not local_ssh_keys:
+            raise WebUIError(f"Local SSH key {pub_key} doesn't match any LambdaLabs keys.")
+        return local_ssh_keys
+
+    def _launch_instance(
+        self,
+        instance_type_name: InstanceTypeName,
+        region_name: RegionName,
+        ssh_keys: List[SSHKey],
+    ) -> Optional[InstanceID]:
+        """Launches a race candidate, returning None if the region has run out of capacity."""
+        try:
+            instance_id = self.lapi.launch_instance(
+                name=self.instance_name,
+                instance_type_name=instance_type_name,
+                region_name=region_name,
+                ssh_keys=ssh_keys,
+            )
+        except (LambdaAPIError, OSError, ValueError) as e:
+            # OSError covers requests failures, ValueError a response that isn't JSON.
+            self.info(f"Failed to launch in {region_name}: {e}")
+            return None
+        self.info(f"Launched LambdaLabs instance {instance_id} in {region_name}")
+        return instance_id
+
+    def _status_racing_instances(self):
+        race = InstanceRace(
+            self.lapi,
+            self.state.race_instances,
+            self.state.creation_time or time.time(),
+            self.state.price_cents_per_hour,
+            self.race_poll_interval_seconds,
+            info=self.info,
+        )
+        winner = race.wait_for_winner()
+        if winner is None:
+            self.info("Every raced instance terminated, restarting from scratch.")
+            self.reset_state()
+            return
+
+        result = race.finish(winner)
+        save_race_result(result)
+        self.info(
+            f"Instance {winner.id} in {winner.region.name} won the race after {result.seconds_to_ready:.0f} seconds, "
+            f"losers cost ${result.loser_cost_cents / 100:.2f}."
+        )
+        self.state.current_instance = winner.id
+        self.state.race_instances = []
+        self._wait_for_ssh(winner)
+        self._transition_status(WebUIStatus.INSTALLING)
+
+    def _wait_for_ssh(self, details: InstanceDetails):
+        """Waits for sshd, pins its host key and warms up the connection.
+
+        Instances report active before sshd is listening, so this replaces a
+        fixed sleep with tight probing, and leaves an open connection and
+        tmux session behind for the installing state.
+        """
+        if details.ip is None:
+            raise WebUIError(f"Instance {details.id} is active but has no IP yet.")
+        start = time.monotonic()
+        if not wait_for_tcp_port(details.ip, 22, self.ssh_ready_timeout_seconds):
+            raise WebUIError(
+                f"SSH on {details.ip} didn't come up within {self.ssh_ready_timeout_seconds} seconds."
+            )
+        host_key = fetch_host_key_with_retries(details.ip, self.ssh_ready_timeout_seconds)
+        pin_host_key(details.ip, host_key, KNOWN_HOSTS_FILE)
+        # Creating the WebUI connects and sets up the tmux session.
+        _ = self.webui
+        self.info(f"SSH ready on {details.ip} after {time.monotonic() - start:.1f} seconds.")
+
     def _status_creating_instance(self):
+        if self.state.race_instances:
+            self._status_racing_instances()
+            return
         assert self.state.current_instance
         while True:
             details = self.lapi.get_instance_details(self.state.current_instance)
             if details.is_active:
                 self.info(f"Instance {self.state.current_instance} is active!")
+                self._wait_for_ssh(details)
                 self._transition_status(WebUIStatus.INSTALLING)
-                time.sleep(5)
                 return
             elif details.is_terminated:
                 self.info(
@@ -276,6 +683,12 @@ class StateMachine:
                 )
                 self.reset_state()
                 return
+            elif details.is_unhealthy:
+                self.info(f"Instance {self.state.current_instance} is unhealthy, replacing it.")
+                if self.state.failure_time is None:
+                    self._record_failure(INSTANCE_DOWN)
+                self._replace_instance(details)
+                return
             else:
                 self.info(
                     f"Instance {self.state.current_instance} is {details.status} and not active yet, checking again in {self.new_instance_poll_interval_seconds} seconds..."
@@ -295,6 +708,9 @@ class StateMachine:
                 is_installed = self.webui.is_webui_installed()
                 is_running = self.webui.is_webui_running()
                 is_accessible = self.webui.is_webui_accessible()
+                self.probes.update(
+                    installed=is_installed, running=is_running, accessible=is_accessible
+                )
                 self.info(
                     f"Installed: {is_installed} Running: {is_running} Accessible: {is_accessible}"
                 )
@@ -304,48 +720,324 @@ class StateMachine:
 
         if not self.webui.is_text2video_extension_installed():
             self.webui.install_text2video_extension()
+        elif not self.webui.models.is_complete():
+            self.webui.install_models()
 
         self._transition_status(WebUIStatus.STARTING)
 
     def _status_starting(self):
+        try:
+            self._start_webui()
+        except WebUIError as e:
+            # Only a restart after failed health checks escalates; a first
+            # start failing is a configuration problem to surface.
+            if self.state.failure_time is None:
+                raise
+            self.info(f"{e} Restarting in place failed, replacing the instance.")
+            self._replace_instance()
+
+    def _start_webui(self):
         if not self.terminal_opened:
             self.webui.open_terminal()
             self.terminal_opened = True
-        self.webui.kill()
-        time.sleep(5)
+
+        is_healthy = self.webui.is_webui_healthy()
+        self.probes["healthy"] = is_healthy
+        if is_healthy:
+            self.info("WebUI is already running with the desired config, reattaching.")
+            self._transition_status(WebUIStatus.RUNNING)
+            return
+
+        if self.webui.is_webui_running():
+            self.info("Stopping WebUI running with a stale config...")
+            self.webui.kill()
+            if not self._wait_for_webui_stopped():
+                self.info("WebUI ignored SIGTERM, sending SIGKILL...")
+                self.webui.kill(force=True)
+            if not self._wait_for_webui_stopped():
+                raise WebUIError(
+                    f"WebUI didn't stop within {self.webui_stop_timeout_seconds} seconds."
+                )
+
+        start_time = time.monotonic()
         self.webui.run()
-        time.sleep(5)
+        if not wait_for(
+            self.webui.is_webui_accessible,
+            self.webui_start_timeout_seconds,
+            self.webui_poll_interval_seconds,
+        ):
+            raise WebUIError(
+                f"WebUI didn't become accessible within {self.webui_start_timeout_seconds} seconds."
+            )
+        self.info(f"WebUI accessible after {time.monotonic() - start_time:.1f} seconds.")
+
+        if self.webui.warm_up():
+            self.info(f"WebUI warmed up after {time.monotonic() - start_time:.1f} seconds.")
+        else:
+            self.info("WebUI warm up generation failed, continuing anyway.")
+
         self._transition_status(WebUIStatus.RUNNING)
 
+    def _wait_for_webui_stopped(self) -> bool:
+        return wait_for(
+            lambda: not self.webui.is_webui_running(),
+            self.webui_stop_timeout_seconds,
+            self.webui_poll_interval_seconds,
+        )
+
     def _status_running(self):
+        if self.state.failure_time is not None:
+            self._record_recovery()
         if not self.terminal_opened:
             self.webui.open_terminal()
             self.terminal_opened = True
-        with self.webui.forward_port():
-            try:
-                self.info("Ready! Open the WebUI at http://localhost:7860/")
-                while True:
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                response = input("Do you want to terminate the instance? y/n:")
-                if response.strip().lower()[0] == "y":
-                    self.lapi.terminate_instances([self.state.current_instance])
-                    self._transition_status(WebUIStatus.TERMINATING)
-                    return
-                else:
-                    print("Not terminating")
-                    sys.exit(0)
+        self.postprocessor = self._new_postprocessor()
+        self.output_sync = self.webui.output_sync(
+            self.local_output_directory,
+            self.postprocessor.submit if self.postprocess_steps else None,
+        )
+        self.output_sync.start()
+        self.tunnels = self.webui.forward_port(self.tunnel_mode, self.tunnel_local_ports)
+        if self.caching_proxy is None:
+            self.result_cache = ResultCache(self.result_cache_directory)
+            self.caching_proxy = CachingProxy(
+                self.result_cache,
+                f"http://localhost:{self.tunnel_local_ports[0]}",
+                self.result_cache_port,
+                retry_timeout_seconds=self.requeue_timeout_seconds,
+            )
+            self.caching_proxy.start()
+        supervisor = HealthSupervisor(
+            self.lapi,
+            self.state.current_instance,
+            self.webui,
+            self.health_check_interval_seconds,
+            self.health_failure_threshold,
+            info=self.info,
+        )
+        failure = None
+        tunnels_retry_time = 0.0
+        self.tunnels.start()
+        try:
+            for tunnel in self.tunnels.tunnels:
+                self.info(
+                    f"Ready! Open the WebUI at http://localhost:{tunnel.local_port}/"
+                )
+            self.info(
+                f"Cached API available at http://localhost:{self.caching_proxy.port}/sdapi/v1/"
+            )
+            while self.running and not self.terminate_requested and failure is None:
+                time.sleep(1)
+                if not self.tunnels.is_alive() and time.monotonic() >= tunnels_retry_time:
+                    if not self._reopen_tunnels():
+                        tunnels_retry_time = time.monotonic() + self.health_check_interval_seconds
+                failure = supervisor.poll()
+                if supervisor.last_check is not None:
+                    if supervisor.last_check.instance_status is not None:
+                        self.probes["instance"] = supervisor.last_check.instance_status == STATUS_ACTIVE
+                    self.probes["ssh"] = supervisor.last_check.ssh_reachable
+                    self.probes["http"] = supervisor.last_check.http_ready
+        except KeyboardInterrupt:
+            response = input("Do you want to terminate the instance? y/n:")
+            self.terminate_requested = response.strip().lower()[:1] == "y"
+        finally:
+            self.tunnels.stop()
+            self.output_sync.close()
+            # When terminating, clips still encoding are finished after the
+            # instance is gone so it isn't billed while the laptop transcodes.
+            if not self.terminate_requested:
+                self.postprocessor.close()
+                self.postprocessor = None
+            self.info(f"Instance was {self.metrics.bottleneck()} recently.")
+
+        if failure is not None:
+            self._recover(failure, supervisor.last_details)
+            return
+        if self.terminate_requested:
+            self._transition_status(WebUIStatus.TERMINATING)
+            return
+        print("Not terminating")
+        sys.exit(0)
+
+    def _reopen_tunnels(self) -> bool:
+        """Replaces the tunnels after their ssh process or transport died.
+
+        The health checks don't go through the tunnels, so they'd miss this.
+        """
+        self.info("Port forwarding died, reopening it...")
+        self.tunnels.stop()
+        try:
+            # Channel mode reconnects the transport here.
+            self.tunnels = self.webui.forward_port(self.tunnel_mode, self.tunnel_local_ports)
+            self.tunnels.start()
+        except (TunnelError, OSError, paramiko.SSHException) as e:
+            self.info(f"Couldn't reopen port forwarding: {e}")
+            return False
+        return True
+
+    def _record_failure(self, failure: str):
+        self.state.failure_time = time.time()
+        self.state.failure_kind = failure
+        self.state.failed_instance = self.state.current_instance
+        save_state(self.state)
+
+    def _recover(self, failure: str, details: Optional[InstanceDetails] = None):
+        """Restarts the WebUI in place, or replaces the instance if it's gone.
+
+        The caching proxy stays up throughout, holding API requests until the
+        WebUI is back.
+        """
+        self._record_failure(failure)
+        if failure == INSTANCE_DOWN:
+            self.info(f"Instance {self.state.current_instance} failed health checks, replacing it.")
+            self._replace_instance(details)
+        else:
+            self.info("WebUI failed health checks, restarting it.")
+            self._transition_status(WebUIStatus.STARTING)
+
+    def _replace_instance(self, details: Optional[InstanceDetails] = None):
+        """Terminates the current instance and launches one of the same type, preferring the same region.
+
+        Outputs are copied off first if SSH still answers, since they're lost
+        with the instance.
+        """
+        failed_instance = self.state.current_instance
+        assert failed_instance
+        if details is None:
+            details = self.lapi.get_instance_details(failed_instance)
+
+        transferred: List[str] = []
+        if self._webui is not None and details.ip is not None and is_tcp_port_open(details.ip, 22):
+            self.info("Syncing outputs off the failed instance...")
+            self._flush_outputs(transferred.append if self.postprocess_steps else None)
+        # Created before current_instance changes, so it reads the failed instance's outputs.
+        postprocessor = self._new_postprocessor() if transferred else None
+        if not details.is_terminated:
+            self.lapi.terminate_instances([failed_instance])
+        self._close_webui()
+
+        instance_type_name = self.state.instance_type or details.instance_type.name
+        region_names = get_race_regions(self.lapi, instance_type_name)
+        region_names.sort(key=lambda region_name: region_name != details.region.name)
+        local_ssh_keys = self._local_ssh_keys()
+        for region_name in region_names:
+            instance_id = self._launch_instance(instance_type_name, region_name, local_ssh_keys)
+            if instance_id is not None:
+                break
+        else:
+            raise WebUIError(f"No capacity to replace instance {failed_instance} with {instance_type_name}.")
+
+        self.state.current_instance = instance_id
+        self.state.creation_time = time.time()
+        self._transition_status(WebUIStatus.CREATING_INSTANCE)
+
+        # Encode while the replacement boots rather than delaying its launch.
+        if postprocessor is not None:
+            for path in transferred:
+                postprocessor.submit(path)
+            postprocessor.close()
+
+    def _record_recovery(self):
+        now = time.time()
+        assert self.state.failure_time is not None and self.state.failure_kind is not None
+        recovery = Recovery(
+            timestamp=now,
+            kind=RECOVERY_KIND_REPLACE
+            if self.state.failed_instance != self.state.current_instance
+            else RECOVERY_KIND_RESTART,
+            failure=self.state.failure_kind,
+            instance_type=self.state.instance_type,
+            failed_instance=self.state.failed_instance,
+            recovered_instance=self.state.current_instance,
+            seconds=now - self.state.failure_time,
+        )
+        save_recovery(recovery)
+        self.recoveries.append(recovery)
+        self.info(
+            f"Recovered by {recovery.kind} after {recovery.seconds:.0f} seconds, "
+            f"mean time to recovery is {mean_time_to_recovery(self.recoveries):.0f} seconds."
+        )
+        self.state.failure_time = None
+        self.state.failure_kind = None
+        self.state.failed_instance = None
+        save_state(self.state)
+
+    @property
+    def local_output_directory(self) -> str:
+        assert self.state.current_instance
+        return os.path.join(self.output_directory, self.state.current_instance)
 
     def _status_terminating(self):
+        if self.caching_proxy is not None:
+            self.caching_proxy.stop()
+            self.caching_proxy = None
+        details = self.lapi.get_instance_details(self.state.current_instance)
+        # Clips are only queued for post-processing once the instance is
+        # terminated, so local encoding never keeps it running.
+        transferred: List[str] = []
+        if details.is_active:
+            # Outputs are lost with the instance, so copy everything before terminating.
+            self.info("Syncing outputs before terminating...")
+            self._flush_outputs(transferred.append if self.postprocess_steps else None)
+        if not details.is_terminated:
+            self.lapi.terminate_instances([self.state.current_instance])
+        self._close_webui()
+
+        postprocessor = self.postprocessor or self._new_postprocessor()
+        self.postprocessor = None
+        for path in transferred:
+            postprocessor.submit(path)
+        postprocessor.close()
+
         while True:
             details = self.lapi.get_instance_details(self.state.current_instance)
-            if details.is_active:
-                print("Still active...")
+            if not details.is_terminated:
+                print(f"Still {details.status}...")
                 time.sleep(5)
-            if details.is_terminated:
+            else:
                 print("Terminated")
                 self.reset_state()
                 sys.exit(0)
 
+    def _new_postprocessor(self) -> PostProcessor:
+        return PostProcessor(
+            self.local_output_directory + "-processed",
+            self.postprocess_steps,
+            input_directory=self.local_output_directory,
+            info=self.info,
+        )
+
+    def _flush_outputs(self, on_transferred: Optional[Callable[[str], None]] = None) -> bool:
+        """Copies every remaining output off the instance, giving up after final_flush_timeout_seconds.
+
+        Returns False if the flush failed or timed out, so callers can carry
+        on terminating rather than leave the instance billing.
+        """
+        errors: List[Exception] = []
+
+        def flush():
+            output_sync = None
+            try:
+                output_sync = self.webui.output_sync(self.local_output_directory, on_transferred)
+                output_sync.flush()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if output_sync is not None:
+                    output_sync.close()
+
+        thread = threading.Thread(target=flush, daemon=True)
+        thread.start()
+        thread.join(self.final_flush_timeout_seconds)
+        if thread.is_alive():
+            self.info(
+                f"Syncing outputs didn't finish within {self.final_flush_timeout_seconds} seconds, giving up."
+            )
+            return False
+        if errors:
+            self.info(f"Syncing outputs failed: {errors[0]}")
+            return False
+        return True
+
     def info(self, text) -> None:
         print(text)